@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# bench.py - runtime cost of UTF-8 bytecode compared to plain bytecode
+# Copyright (C) 2021  Arusekk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import glob
+import io
+import json
+import marshal
+import os
+import platform
+import statistics
+import sys
+import time
+
+import utfpyc
+
+
+def code_objects(co):
+    yield co
+    for const in co.co_consts:
+        if hasattr(const, 'co_code'):
+            yield from code_objects(const)
+
+
+def instructions(co):
+    return sum(len(c.co_code) // 2 for c in code_objects(co))
+
+
+def summary(samples):
+    return {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def timings(funcs, repeat, number):
+    # seconds per call of each function, with the rounds interleaved so
+    # that drift and warm-up hit them all alike; the first is discarded
+    samples = [[] for _ in funcs]
+    for _ in range(repeat + 1):
+        for func, times in zip(funcs, samples):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            times.append((time.perf_counter() - start) / number)
+    return [summary(times[1:]) for times in samples]
+
+
+def run_module(code, name):
+    namespace = {'__name__': name}
+    exec(code, namespace)
+    return namespace
+
+
+def measure(datas, name, repeat, number):
+    codes = [marshal.loads(data) for data in datas]
+    mains = [run_module(code, name)['main'] for code in codes]
+    results = [{'size': len(data), 'instructions': instructions(code)}
+               for data, code in zip(datas, codes)]
+    for key, funcs in (
+            ('loads', [lambda data=data: marshal.loads(data)
+                       for data in datas]),
+            ('exec', [lambda code=code: run_module(code, name)
+                      for code in codes]),
+            ('main', mains)):
+        for result, stats in zip(results, timings(funcs, repeat, number)):
+            result[key] = stats
+    return results
+
+
+def bench(path, repeat=10, number=10, refs=False):
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as fp:
+        co = compile(fp.read(), os.path.abspath(path), 'exec')
+
+    fp = io.BytesIO()
+    dumper = utfpyc.NorefMarshalDumper(fp, force=True, refs=refs)
+    dumper.dump(co)
+    data = fp.getvalue()
+    try:
+        data.decode()
+        valid = True
+    except UnicodeDecodeError:
+        valid = False
+
+    plain, utf8 = measure([marshal.dumps(co), data], name, repeat, number)
+    ratios = {key: utf8[key] / plain[key] for key in ('size', 'instructions')}
+    for key in ('loads', 'exec', 'main'):
+        ratios[key] = utf8[key]['median'] / plain[key]['median']
+    return {'workload': name, 'valid': valid, 'plain': plain,
+            'utf8': utf8, 'ratio': ratios}
+
+
+def main():
+    import argparse
+
+    par = argparse.ArgumentParser(
+        description='compare plain and UTF-8 bytecode of workloads')
+    par.add_argument('workloads', nargs='*',
+                     help='scripts defining main() (default: bench/*.py)')
+    par.add_argument('-r', '--repeat', type=int, default=10,
+                     help='timing rounds per measurement '
+                          '(default: %(default)s)')
+    par.add_argument('-n', '--number', type=int, default=10,
+                     help='calls per timing round (default: %(default)s)')
+    par.add_argument('--refs', action='store_true',
+                     help='transcode with references, as utfpyc --refs')
+    par.add_argument('-o', '--output', default=None,
+                     help='write the results as JSON to this file')
+    args = par.parse_args()
+
+    workloads = args.workloads or sorted(glob.glob(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'bench', '*.py')))
+
+    results = []
+    for path in workloads:
+        result = bench(path, args.repeat, args.number, args.refs)
+        results.append(result)
+        ratio = result['ratio']
+        print(f"{result['workload']:16} size {ratio['size']:.3f} "
+              f"instrs {ratio['instructions']:.3f} "
+              f"loads {ratio['loads']:.3f} exec {ratio['exec']:.3f} "
+              f"main {ratio['main']:.3f}"
+              + ('' if result['valid'] else ' (not UTF-8)'))
+
+    if args.output is not None:
+        report = {
+            'utfpyc': utfpyc.__version__,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'number': args.number,
+            'refs': args.refs,
+            'results': results,
+        }
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+def main():
+    squares = [i * i for i in range(1024)]
+    evens = {i: s for i, s in enumerate(squares) if s % 2 == 0}
+    pairs = {(a, b) for a in range(30) for b in range(30) if a < b}
+    return sum(x for x in evens.values()) + len(pairs)
@@ -0,0 +1,8 @@
+def main():
+    total = 0
+    for i in range(2048):
+        j = i
+        while j:
+            total += j & 1
+            j >>= 1
+    return total
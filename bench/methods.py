@@ -0,0 +1,20 @@
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __add__(self, other):
+        return Point(self.x + other.x, self.y + other.y)
+
+    def norm(self):
+        return abs(self.x) + abs(self.y)
+
+
+def main():
+    p = Point(0, 0)
+    step = Point(1, 2)
+    total = 0
+    for _ in range(1024):
+        p = p + step
+        total += p.norm()
+    return total
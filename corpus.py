@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# corpus.py - transcoding throughput and output size over a large corpus
+# Copyright (C) 2021  Arusekk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import json
+import marshal
+import os
+import platform
+import resource
+import statistics
+import sys
+import sysconfig
+import time
+import warnings
+
+from concurrent.futures import ProcessPoolExecutor
+
+import utfpyc
+
+
+# how each module came out: valid UTF-8 as it is, only with -f, not at
+# all, or it does not even compile
+OUTCOMES = ('direct', 'forced', 'failed', 'skipped')
+
+
+def default_corpus():
+    # the installed stdlib and site-packages, which may well be in it
+    paths = []
+    for key in ('stdlib', 'purelib', 'platlib'):
+        path = os.path.realpath(sysconfig.get_paths()[key])
+        if os.path.isdir(path) and not any(
+                path == p or path.startswith(p + os.sep) for p in paths):
+            paths.append(path)
+    return paths
+
+
+def transcode(path):
+    # the outcome of one module, and what it took
+    result = {'path': path, 'outcome': 'skipped', 'functions': 0,
+              'size': 0, 'new_size': 0, 'time': 0.0}
+    try:
+        with open(path, 'rb') as fp, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            co = compile(fp.read(), path, 'exec')
+    except (SyntaxError, ValueError):
+        return result
+    result['functions'] = sum(1 for _ in utfpyc.code_tree(co))
+    result['size'] = len(marshal.dumps(co))
+
+    start = time.process_time()
+    for force, outcome in ((False, 'direct'), (True, 'forced')):
+        fp = io.BytesIO()
+        try:
+            utfpyc.NorefMarshalDumper(fp, force).dump(co)
+        except Exception as e:
+            # whatever dump_staged() would try a stager for, -f may help
+            if not force and isinstance(e, (ValueError, AssertionError)):
+                continue
+            result['error'] = f'{type(e).__name__}: {e}'
+            outcome = 'failed'
+        result['outcome'] = outcome
+        result['new_size'] = len(fp.getvalue())
+        break
+    else:
+        result['outcome'] = 'failed'
+    result['time'] = time.process_time() - start
+    return result
+
+
+def peak_memory():
+    # in bytes, of this process or any worker, which Linux gives in KiB
+    return 1024 * max(resource.getrusage(who).ru_maxrss for who in (
+        resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(modules, wall):
+    done = [m for m in modules if m['outcome'] in ('direct', 'forced')]
+    ratios = [m['new_size'] / m['size'] for m in done]
+    functions = sum(m['functions'] for m in modules)
+    size = sum(m['size'] for m in modules)
+    return {
+        'modules': len(modules),
+        'outcomes': {outcome: sum(m['outcome'] == outcome for m in modules)
+                     for outcome in OUTCOMES},
+        'functions': functions,
+        'bytes': size,
+        'wall': wall,
+        'cpu': sum(m['time'] for m in modules),
+        'functions_per_second': functions / wall,
+        'bytes_per_second': size / wall,
+        'peak_memory': peak_memory(),
+        'inflation': {
+            'total': (sum(m['new_size'] for m in done)
+                      / max(sum(m['size'] for m in done), 1)),
+            'median': statistics.median(ratios) if ratios else None,
+            'p90': percentile(ratios, 0.9),
+            'max': max(ratios, default=None),
+        },
+    }
+
+
+def run(paths, workers=1):
+    sources = sorted({os.path.abspath(src)
+                      for src, _ in utfpyc.iter_sources(paths)})
+    start = time.perf_counter()
+    if workers == 1:
+        modules = list(map(transcode, sources))
+    else:
+        with ProcessPoolExecutor(workers or None) as pool:
+            modules = list(pool.map(transcode, sources, chunksize=4))
+    return modules, summarize(modules, time.perf_counter() - start)
+
+
+def compare(report, baseline, tolerance=0.25, size_tolerance=0.005):
+    # everything that got worse than in baseline, beyond the tolerances
+    # for timing and memory, which are noisy, and for sizes, which are not
+    problems = []
+    new, old = report['summary'], baseline['summary']
+    for key, label in (('functions_per_second', 'functions/s'),
+                       ('bytes_per_second', 'bytes/s')):
+        if new[key] < old[key] * (1 - tolerance):
+            problems.append(f'{label} down from {old[key]:.0f} '
+                            f'to {new[key]:.0f}')
+    if new['peak_memory'] > old['peak_memory'] * (1 + tolerance):
+        problems.append(f'peak memory up from {old["peak_memory"] >> 20} '
+                        f'to {new["peak_memory"] >> 20} MiB')
+    if new['inflation']['total'] > (old['inflation']['total']
+                                    * (1 + size_tolerance)):
+        problems.append(f'size inflation up from '
+                        f'{old["inflation"]["total"]:.4f} to '
+                        f'{new["inflation"]["total"]:.4f}')
+
+    # modules only count where both runs know them, so that the corpus
+    # may grow without everything new counting as a regression
+    olds = {m['path']: m for m in baseline['modules']}
+    for m in report['modules']:
+        o = olds.get(m['path'])
+        if o is None:
+            continue
+        if OUTCOMES.index(m['outcome']) > OUTCOMES.index(o['outcome']):
+            problems.append(f'{m["path"]}: {o["outcome"]} before, '
+                            f'{m["outcome"]} now')
+        elif (m['outcome'] == o['outcome'] != 'skipped'
+              and m['size'] == o['size']
+              and m['new_size'] > o['new_size'] * (1 + size_tolerance)):
+            problems.append(f'{m["path"]}: {o["new_size"]} bytes before, '
+                            f'{m["new_size"]} now')
+    return problems
+
+
+def main():
+    import argparse
+
+    par = argparse.ArgumentParser(
+        description='transcode a corpus of modules, report throughput, '
+                    'memory, outcomes and size inflation, and compare '
+                    'them against a baseline')
+    par.add_argument('paths', nargs='*',
+                     help='files, directories and globs (default: the '
+                          'installed stdlib and site-packages)')
+    par.add_argument('-j', '--workers', type=int, default=0,
+                     help='number of worker processes '
+                          '(default: one per CPU)')
+    par.add_argument('-o', '--output', default=None,
+                     help='write the results as JSON to this file, '
+                          'for a later --baseline')
+    par.add_argument('--baseline', default=None, metavar='FILE',
+                     help='fail on regressions against the results in FILE')
+    par.add_argument('--tolerance', type=float, default=0.25,
+                     help='fraction by which throughput and memory may be '
+                          'worse than the baseline (default: %(default)s)')
+    par.add_argument('--size-tolerance', type=float, default=0.005,
+                     help='fraction by which output sizes may be bigger '
+                          'than the baseline (default: %(default)s)')
+    args = par.parse_args()
+
+    modules, summary = run(args.paths or default_corpus(), args.workers)
+    counts = summary['outcomes']
+    inflation = summary['inflation']
+    print(f"modules {summary['modules']}: "
+          + ', '.join(f'{counts[outcome]} {outcome}' for outcome in OUTCOMES))
+    print(f"functions {summary['functions']} in {summary['wall']:.1f}s: "
+          f"{summary['functions_per_second']:.0f}/s, "
+          f"{summary['bytes_per_second'] / 1e6:.2f} MB/s, "
+          f"peak memory {summary['peak_memory'] >> 20} MiB")
+    if inflation['median'] is not None:
+        print(f"size inflation {inflation['total']:.4f} in total, "
+              f"{inflation['median']:.4f} median, "
+              f"{inflation['p90']:.4f} p90, {inflation['max']:.4f} max")
+
+    report = {
+        'utfpyc': utfpyc.__version__,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'workers': args.workers,
+        'summary': summary,
+        'modules': modules,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            problems = compare(report, json.load(fp), args.tolerance,
+                               args.size_tolerance)
+        for problem in problems:
+            print(f'REGRESSION {problem}', file=sys.stderr)
+        sys.exit(bool(problems))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import codecs
 import struct
 from enum import IntEnum
 
@@ -66,6 +67,91 @@ class u8char(int):
         return self.type == U8.start4
 
 
+# plain int twins of U8 and a table of them for every byte value,
+# so that hot loops need not create u8char objects
+ASCII, CONT, START2, START3, START4, INVALID = map(int, U8)
+TYPES = bytes(u8char(i).type for i in range(256))
+
+
+# states of a UTF-8 decoder, as (continuation bytes still expected,
+# lowest and highest value allowed for the next one), and the state
+# every byte leads to from each of them
+DECODER_STATES = ((0, 0x00, 0x7f), (1, 0x80, 0xbf), (2, 0x80, 0xbf),
+                  (2, 0xa0, 0xbf), (2, 0x80, 0x9f), (3, 0x80, 0xbf),
+                  (3, 0x90, 0xbf), (3, 0x80, 0x8f))
+BAD_STATE = 0xff
+_special_leads = {0xe0: 3, 0xed: 4, 0xf0: 6, 0xf4: 7}
+
+
+def _next_state(state, b):
+    left, lo, hi = DECODER_STATES[state]
+    if left:
+        # (left - 1, 0x80, 0xbf) is state left - 1
+        return left - 1 if lo <= b <= hi else BAD_STATE
+    if b < 0x80:
+        return 0
+    if 0xc2 <= b < 0xe0:
+        return 1
+    if b in _special_leads:
+        return _special_leads[b]
+    if 0xe1 <= b < 0xf0:
+        return 2
+    if 0xf1 <= b < 0xf4:
+        return 5
+    return BAD_STATE
+
+
+NEXT_STATE = tuple(bytes(_next_state(state, b) for b in range(256))
+                   for state in range(len(DECODER_STATES)))
+
+
+def char_type(val):
+    if val is None:
+        return ASCII
+    if val < 256:
+        return TYPES[val]
+    return INVALID
+
+
+def char_types(bs):
+    # U8 value of every byte in bs, in one call
+    if type(bs).__module__ == 'numpy':
+        import numpy
+        return numpy.frombuffer(TYPES, numpy.uint8)[bs]
+    return bytes(bs).translate(TYPES)
+
+
+class Validator:
+    # resumable UTF-8 checker remembering where things first went wrong
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.offset = 0
+        self.error = None
+        self.error_state = None
+
+    def feed(self, bs, final=False):
+        bs = bytes(bs)
+        if self.error is None:
+            pending = self.decoder.getstate()[0]
+            try:
+                self.decoder.decode(bs, final)
+            except UnicodeDecodeError as e:
+                self.error = self.offset - len(pending) + e.start
+                self.error_state = U8(TYPES[e.object[e.start]])
+        self.offset += len(bs)
+        return self.error is None
+
+    def close(self):
+        return self.feed(b'', True)
+
+
+def first_invalid(bytestring):
+    v = Validator()
+    if v.feed(bytestring, True):
+        return None
+    return v.error, v.error_state
+
+
 def invalidu32(num):
     return invalid(struct.pack('<I', num))
 
@@ -76,9 +162,8 @@ def hexdump(bs):
 
 def hexdump_iter(bs):
     line = ["  "] * 16
-    for i, x in enumerate(bs):
-        x = u8char(x)
-        line[i & 15] = f'\33[1;3{x.type + 1}m{x:02x}\33[m'
+    for i, (x, t) in enumerate(zip(bs, char_types(bs))):
+        line[i & 15] = f'\33[1;3{t + 1}m{x:02x}\33[m'
         if i % 16 == 15:
             yield f'{i//16:07x}0 {" ".join(line)}\n'
             line = ["  "] * 16
@@ -7,6 +7,9 @@ set -e
 # run the result again
 python3 utfpyc.pyc -f utfpyc.py utfpyc2.pyc
 cmp utfpyc.pyc utfpyc2.pyc
+# transcoding code objects in parallel must not change a thing
+./utfpyc.py -j 2 -f utfpyc.py utfpyc2.pyc
+cmp utfpyc.pyc utfpyc2.pyc
 
 for script in test/*.py; do
     # compare the original script and self-compiled script results on tests
@@ -17,5 +20,240 @@ for script in test/*.py; do
     python3 "$script" >"$script.out"
     python3 "${script%.py}.pyc" >"${script%.py}.pyc.out"
     cmp "$script.out" "${script%.py}.pyc.out"
+    # and with references
+    ./utfpyc.py --refs "$script" "${script%.py}.refs.pyc"
+    python3 "${script%.py}.refs.pyc" >"${script%.py}.refs.pyc.out"
+    cmp "$script.out" "${script%.py}.refs.pyc.out"
+    # and packed into a stager
+    ./utfpyc.py --stager "$script" "${script%.py}.stager.pyc"
+    python3 "${script%.py}.stager.pyc" >"${script%.py}.stager.pyc.out"
+    cmp "$script.out" "${script%.py}.stager.pyc.out"
+done
+
+
+# batch mode must produce the same output as single-file mode, which
+# must check out statically as well
+./utfpyc.py -j 2 --verify -o test/batch test
+for script in test/*.py; do
+    name="${script#test/}"
+    cmp "${script%.py}.pyc" "test/batch/${name%.py}.pyc"
+done
+rm -r test/batch
+
+# cached code objects must produce the same output
+./utfpyc.py --cache-dir test/cache -j 2 -o test/batch test
+./utfpyc.py --cache-dir test/cache -j 2 -o test/batch2 test
+for script in test/*.py; do
+    name="${script#test/}"
+    cmp "${script%.py}.pyc" "test/batch/${name%.py}.pyc"
+    cmp "${script%.py}.pyc" "test/batch2/${name%.py}.pyc"
+done
+rm -r test/cache test/batch test/batch2
+
+# modules that no transcoding can help go into stagers of their own,
+# unless told not to, which leaves no output behind
+mkdir test/auto
+echo 'print(-1)' >test/auto/neg.py
+./utfpyc.py test/auto/neg.py test/auto/neg.pyc
+./utfpyc.py -o test/auto/batch test/auto
+for pyc in test/auto/neg.pyc test/auto/batch/neg.pyc; do
+    python3 -c "open('$pyc', 'rb').read().decode()"
+    test "$(python3 "$pyc")" = -1
+done
+if ./utfpyc.py --no-stager test/auto/neg.py test/auto/no.pyc 2>/dev/null; then
+    exit 1
+fi
+test ! -e test/auto/no.pyc
+rm -r test/auto
+
+# a server compiles the same as a process of its own
+./utfpyc.py serve -j 1 test/serve.sock >test/serve.log &
+server=$!
+while [ ! -S test/serve.sock ]; do sleep 0.1; done
+for script in test/*.py; do
+    UTFPYC_SOCKET=test/serve.sock ./utfpyc_client.py "$script" "${script%.py}.served.pyc"
+    cmp "${script%.py}.pyc" "${script%.py}.served.pyc"
 done
+UTFPYC_SOCKET=test/serve.sock ./utfpyc_client.py - - <test/consts_01.py >test/stdin.served.pyc
+./utfpyc.py - - <test/consts_01.py | cmp test/stdin.served.pyc -
+# a command line run elsewhere leaves relative paths alone, and --version
+# goes to the client
+(cd test && UTFPYC_SOCKET=serve.sock ../utfpyc_client.py consts_01.py stdin.served.pyc)
+python3 -c '
+import json, socket
+with socket.socket(socket.AF_UNIX) as sock:
+    sock.connect("test/serve.sock")
+    sock.sendall(b"{\"path\": \"test/consts_01.py\"}\n")
+    assert "pyc" in json.loads(sock.makefile().readline())
+'
+python3 -c '
+import json, socket
+with socket.socket(socket.AF_UNIX) as sock:
+    sock.connect("test/serve.sock")
+    sock.sendall(b"{\"argv\": [\"serve\", \"test/nested.sock\"], \"cwd\": \".\"}\n")
+    assert "error" in json.loads(sock.makefile().readline())
+'
+test ! -e test/nested.sock
+UTFPYC_SOCKET=test/serve.sock ./utfpyc_client.py --version | grep -q "$(python3 -c 'import utfpyc; print(utfpyc.__version__)')"
+kill $server
+wait $server
+test ! -s test/serve.log
+rm test/stdin.served.pyc test/serve.log
 
+# statistics come out for every code object, in both formats
+./utfpyc.py --stats test/stats.json -o test/batch test
+./utfpyc.py --stats test/stats.csv -o test/batch test
+python3 -c 'import json, sys; sys.exit(not json.load(open("test/stats.json")))'
+test "$(wc -l <test/stats.csv)" -gt 1
+rm -r test/batch test/stats.json test/stats.csv
+
+# a profile only moves the padding around
+./utfpyc.py profile -o test/profile.json test/ext_01.py >/dev/null
+./utfpyc.py --verify --profile test/profile.json test/ext_01.py test/ext_01.hot.pyc
+python3 test/ext_01.hot.pyc | cmp test/ext_01.py.out -
+rm test/profile.json test/ext_01.hot.pyc
+
+# the benchmark harness must run through all workloads
+./bench.py -r 1 -n 1 -o test/bench.json >/dev/null
+rm test/bench.json
+
+# and the corpus suite, which must pass against a baseline of its own;
+# timings of so few modules are all noise
+./corpus.py -j 2 -o test/corpus.json test >/dev/null
+./corpus.py -j 2 --tolerance 10 --baseline test/corpus.json test >/dev/null
+rm test/corpus.json
+
+# headers that CPython can check stay valid UTF-8
+mkdir test/hook
+cp test/consts_01.py test/hook/hooked.py
+for mode in timestamp checked-hash unchecked-hash; do
+    ./utfpyc.py --invalidation-mode "$mode" test/hook/hooked.py test/hook/h.pyc
+    python3 -c 'open("test/hook/h.pyc", "rb").read().decode()'
+    python3 test/hook/h.pyc | cmp test/consts_01.py.out -
+done
+
+# the import hook writes UTF-8 pycs to __pycache__ and refreshes them,
+# given an mtime that is valid UTF-8
+python3 -c 'import os; os.utime("test/hook/hooked.py", (1600000000, 1600000000))'
+hook='import sys, utfpyc; utfpyc.install_hook(); sys.path.insert(0, "test/hook"); import hooked'
+pyc='import importlib.util; print(importlib.util.cache_from_source("test/hook/hooked.py"))'
+PYTHONDONTWRITEBYTECODE= python3 -c "$hook" >test/hook/out1
+python3 -c "open('$(python3 -c "$pyc")', 'rb').read().decode()"
+PYTHONDONTWRITEBYTECODE= python3 -c "$hook" >test/hook/out2
+cmp test/hook/out1 test/hook/out2
+echo 'print("changed")' >>test/hook/hooked.py
+PYTHONDONTWRITEBYTECODE= python3 -c "$hook" | grep -q changed
+# and never an unchecked one, which CPython without it would run after
+# edits, here for an mtime and a source hash that are both invalid
+echo 'print("v1")' >test/hook/stale.py
+python3 -c 'import os; os.utime("test/hook/stale.py", (1600000128, 1600000128))'
+PYTHONDONTWRITEBYTECODE= python3 -c 'import sys, utfpyc; utfpyc.install_hook(); sys.path.insert(0, "test/hook"); import stale' >/dev/null
+echo 'print("v2")' >test/hook/stale.py
+PYTHONDONTWRITEBYTECODE= python3 -c 'import sys; sys.path.insert(0, "test/hook"); import stale' | grep -q v2
+# and modules that cannot be made valid import all the same, here one
+# whose code is not, with an mtime and size that are
+python3 -c '
+import bz2, os, shutil, utfpyc
+shutil.copy(bz2.__file__, "test/hook/hookbz2.py")
+while utfpyc.invalidu32(os.stat("test/hook/hookbz2.py").st_size):
+    with open("test/hook/hookbz2.py", "a") as fp:
+        fp.write("#")
+os.utime("test/hook/hookbz2.py", (1600000000, 1600000000))
+'
+PYTHONDONTWRITEBYTECODE= python3 -c 'import sys, utfpyc; utfpyc.install_hook(); sys.path.insert(0, "test/hook"); import hookbz2'
+rm -r test/hook
+
+# the library API compiles in memory as the command line does, from
+# several threads at once
+python3 -c '
+import os, sys, threading, utfpyc
+with open("test/consts_01.py", "rb") as fp:
+    source = fp.read()
+with open("test/consts_01.pyc", "rb") as fp:
+    expected = fp.read()
+cache = utfpyc.MemoryCache()
+results = []
+def work():
+    results.append(utfpyc.compile_source(
+        source, os.path.abspath("test/consts_01.py"), cache=cache))
+threads = [threading.Thread(target=work) for _ in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+sys.exit(results != [expected] * 4)
+'
+python3 -c '
+import sys, utfpyc
+warnings = []
+utfpyc.compile_source("print(-1)", force=True, warnings=warnings)
+sys.exit(warnings != ["invalid start byte in co_consts of <module>"])
+'
+
+# pycs and marshalled code as input, and sourceless pycs in bulk, but
+# only when asked for, and never anywhere they would be imported from
+mkdir -p test/sourceless
+cp test/consts_01.py test/ext_01.py test/sourceless/
+python3 -m compileall -q test/sourceless
+rm test/sourceless/*.py
+./utfpyc.py -o test/sourceless/build test/sourceless
+test ! -e test/sourceless/build
+./utfpyc.py -o test/sourceless/build --sourceless test/sourceless
+test ! -e test/sourceless/build/consts_01.pyc
+python3 -c 'open(__import__("glob").glob("test/sourceless/build/__pycache__/consts_01.*.pyc")[0], "rb").read().decode()'
+rm -r test/sourceless/build
+./utfpyc.py --pycache --sourceless test/sourceless
+for pyc in test/sourceless/__pycache__/*.pyc; do
+    python3 -c 'import sys; open(sys.argv[1], "rb").read().decode()' "$pyc"
+done
+python3 test/sourceless/__pycache__/consts_01.*.pyc | cmp test/consts_01.py.out -
+python3 -c 'import marshal, sys; sys.stdout.buffer.write(marshal.dumps(compile(open("test/ext_01.py").read(), "ext_01.py", "exec")))' >test/sourceless/ext_01.marshal
+./utfpyc.py --input-format marshal test/sourceless/ext_01.marshal test/sourceless/ext_01.pyc
+python3 -c 'open("test/sourceless/ext_01.pyc", "rb").read().decode()'
+python3 test/sourceless/ext_01.pyc | cmp test/ext_01.py.out -
+echo 'print(1)' >test/sourceless/junk.pyc
+if ./utfpyc.py test/sourceless/junk.pyc test/sourceless/out.pyc 2>/dev/null; then
+    exit 1
+fi
+test ! -e test/sourceless/out.pyc
+# source that starts like marshalled code is still source
+printf 'class C:\n    pass\nprint("c")\n' >test/sourceless/c.py
+./utfpyc.py test/sourceless/c.py test/sourceless/c.pyc
+test "$(python3 test/sourceless/c.pyc)" = c
+rm -r test/sourceless
+
+# a bundle runs its __main__, and imports its modules when asked to
+mkdir -p test/bundle/pkg
+echo 'import sys, pkg.sub; print(pkg.sub.VALUE, "pkg.other" in sys.modules)' >test/bundle/__main__.py
+echo 'print("pkg")' >test/bundle/pkg/__init__.py
+echo 'VALUE = 42' >test/bundle/pkg/sub.py
+echo 'raise SystemExit(1)' >test/bundle/pkg/other.py
+cp test/consts_01.py test/bundle/
+echo 'X = -1' >test/bundle/neg.py
+./utfpyc.py -j 2 --bundle test/app.pyc test/bundle 2>test/bundle.err
+grep -q 'neg.py: warning: using a stager' test/bundle.err
+rm test/bundle.err
+python3 -c 'open("test/app.pyc", "rb").read().decode()'
+test "$(python3 test/app.pyc | tr '\n' ' ')" = "pkg 42 False "
+python3 -c 'import sys; sys.path.insert(0, "test"); import app, consts_01' | cmp test/consts_01.py.out -
+rm -r test/bundle test/app.pyc
+
+# the 3.10 and 3.11 backends, wherever those interpreters are around;
+# forced, as no 3.11 pyc is valid UTF-8, starting with its magic number
+if python3.11 -c "" 2>/dev/null; then
+    if python3.11 utfpyc.py test/consts_01.py test/none.pyc 2>/dev/null; then
+        exit 1
+    fi
+    test ! -e test/none.pyc
+fi
+for python in python3.10 python3.11; do
+    "$python" -c "" 2>/dev/null || continue
+    for script in test/*.py; do
+        # its payload is 3.9 bytecode
+        [ "$script" = test/stager.py ] && continue
+        "$python" utfpyc.py -f --verify "$script" "${script%.py}.other.pyc"
+        "$python" "$script" >"$script.other.out"
+        "$python" "${script%.py}.other.pyc" >"${script%.py}.other.pyc.out"
+        cmp "$script.other.out" "${script%.py}.other.pyc.out"
+    done
+done
@@ -0,0 +1,7 @@
+x = 1
+print(x, 0, True, False, type(x), type(0))
+print(1.5, -0.25, 1e300, 2+3j, 1j)
+print(2**40, 2**100, 10**6)
+print('héllo', 'ü' * 150)
+print(sorted(frozenset({1, 2, 3})), 3 in {1, 2, 3})
+print(len((1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40)))
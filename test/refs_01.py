@@ -0,0 +1,15 @@
+LONG = 'a string long enough to be written once and then referenced, ' \
+       'as marshal can only flag short ASCII strings of 128 up to 191 chars'
+
+
+def first():
+    return 'a string long enough to be written once and then referenced, ' \
+           'as marshal can only flag short ASCII strings of 128 up to 191 chars'
+
+
+def second():
+    return 'a string long enough to be written once and then referenced, ' \
+           'as marshal can only flag short ASCII strings of 128 up to 191 chars'
+
+
+print(len(LONG), LONG == first() == second())
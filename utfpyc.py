@@ -15,257 +15,873 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-__version__ = '1.0'
+# keys the transcode cache too, so it goes up whenever the output changes
+__version__ = '1.2'
 
 
+import base64
+import codecs
+import contextlib
+import csv
 import dis
+import functools
+import glob
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import marshal
 import os
+import runpy
+import signal
+import socket
 import struct
-
-from itertools import zip_longest
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, OrderedDict
+from inspect import CO_VARARGS, CO_VARKEYWORDS
+from types import CodeType
 from importlib._bootstrap_external import MAGIC_NUMBER
 
-from libutf8 import U8, u8char, invalid, invalidu32, maybe_bigger, hexdump
-
-
-def mk_extended_arg(arg, extended):
-    return dis.Instruction(
-        opname='EXTENDED_ARG', opcode=dis.EXTENDED_ARG, arg=arg, argval=arg,
-        argrepr=None, offset=extended.offset, starts_line=extended.starts_line,
-        is_jump_target=extended.is_jump_target)
-
-
-def _unpack_opargs(code):
-    extended_arg = 0
-    for i in range(0, len(code), 2):
-        op = code[i]
-        if op >= dis.HAVE_ARGUMENT:
-            arg = code[i+1] | extended_arg
-        else:
-            arg = None
-        # in stock dis, this is done only in the HAVE_ARGUMENT branch
-        # and that is wrong, since it is different from ceval.c logic
-        extended_arg = (arg << 8) if op == dis.EXTENDED_ARG else 0
-        yield (i, op, arg)
-
+from libutf8 import (ASCII, BAD_STATE, CONT, DECODER_STATES, NEXT_STATE,
+                     Validator, char_type, first_invalid, invalid,
+                     invalidu32, maybe_bigger, hexdump)
 
-dis._unpack_opargs = _unpack_opargs
 
 ANY_ASCII = ord('S')
-empty_instr = dis.Instruction(
-    opname=None, opcode=None, arg=None, argval=None, argrepr=None,
-    offset=None, starts_line=None, is_jump_target=None)
-
-
-class CodeWrapper:
-    def __init__(self, code, **attrs):
-        self.__dict__.update(attrs)
-        self.code = code
-
-    def __getattr__(self, attr):
-        return getattr(self.code, attr)
+NOP = dis.opmap['NOP']
+CACHE = dis.opmap.get('CACHE')
+ERROR_COST = 1 << 20
+# one lead byte for each length of sequence
+LEADS = (0xc3, 0xe1, 0xf1)
+
+
+def is_jump(op):
+    return op in dis.hasjrel or op in dis.hasjabs
+
+
+def ext_count(arg):
+    count = 0
+    while arg is not None and arg >= 256:
+        arg >>= 8
+        count += 1
+    return count
+
+
+def stuck_byte(op, b):
+    # no padding can make b valid right after op; a continuation after a
+    # continuation only needs a lead byte before both
+    return byte_cost(b) > 1 and not (char_type(op) == char_type(b) == CONT)
+
+
+def free_bytes(state, ascii=ANY_ASCII):
+    # a byte for every state that an unconstrained byte can lead to
+    left, lo, hi = DECODER_STATES[state]
+    if left:
+        return (lo,)
+    return (ascii,) + LEADS
+
+
+def recover(b):
+    # the state after a bad byte, as if it were the first one
+    state = NEXT_STATE[0][b]
+    return 0 if state == BAD_STATE else state
+
+
+@functools.lru_cache(maxsize=None)
+def pad_closure(key):
+    # the shortest padding from (state, pending) to each one reachable;
+    # pending means an EXTENDED_ARG with a nonzero arg must be followed
+    # by an instruction that ignores it
+    best = {key: ()}
+    todo = [key]
+    for state, pending in todo:
+        for op in (NOP, dis.EXTENDED_ARG):
+            after = NEXT_STATE[state][op]
+            if after == BAD_STATE:
+                continue
+            extended = op == dis.EXTENDED_ARG
+            for arg in free_bytes(after, 0 if extended else ANY_ASCII):
+                nxt = (NEXT_STATE[after][arg],
+                       extended and (pending or arg != 0))
+                if nxt[0] != BAD_STATE and nxt not in best:
+                    best[nxt] = best[state, pending] + (op, arg)
+                    todo.append(nxt)
+    return best
+
+
+@functools.lru_cache(maxsize=None)
+def routes(key, op, gap):
+    # the cheapest padding to each state right after opcode op, as
+    # (state, pads, errors); there is no gap right after an EXTENDED_ARG,
+    # as padding would cut it off from its instruction
+    best = {}
+    for (state, pending), pads in (pad_closure(key) if gap
+                                   else {key: ()}).items():
+        if pending and op >= dis.HAVE_ARGUMENT:
+            continue
+        after = NEXT_STATE[state][op]
+        if after != BAD_STATE and len(best.get(after, pads)) >= len(pads):
+            best[after] = pads
+    if not best:
+        return ((recover(op), (), ERROR_COST),)
+    return tuple((after, pads, 0) for after, pads in best.items())
+
+
+def slot_cost(i):
+    # how much padding an operand index is likely to need after an ASCII
+    # opcode, which all but LOAD_METHOD are
+    return (stuck_byte(ANY_ASCII, i & 0xff), ext_count(i),
+            byte_cost(i & 0xff), i)
+
+
+def byte_cost(b):
+    # 0 for ASCII, 1 for a lead byte that EXTENDED_ARG 0x80 can complete
+    # at the end of a block, 2 otherwise
+    if b < 0x80:
+        return 0
+    if 0xc2 <= b < 0xf4 and b != 0xe0:
+        return 1
+    return 2
+
+
+def line_ranges(lines, firstlineno, size, increasing=True):
+    # (start, end, line) for the code between line starts; the first
+    # start wins at any offset, and with increasing, lines that would go
+    # back are dropped as well
+    ranges = [[0, firstlineno]]
+    for offset, lineno in lines:
+        if lineno == ranges[-1][1] or increasing and lineno < ranges[-1][1]:
+            continue
+        if offset == ranges[-1][0]:
+            if offset == 0:
+                ranges[-1][1] = lineno
+            continue
+        ranges.append([offset, lineno])
+    ends = [start for start, _ in ranges[1:]] + [size]
+    return [(start, end, lineno)
+            for (start, lineno), end in zip(ranges, ends)]
+
+
+class Backend:
+    # CPython 3.8 and 3.9: jumps in bytes, co_lnotab
+    unit = 1
+    line_field = 'co_lnotab'
+    # line numbers that go back are dropped from the line table
+    increasing = True
+    tables = ('co_consts', 'co_names', 'co_varnames')
+    code_pad = (ANY_ASCII,)
+    header = struct.Struct('<c6I')
+
+    def caches(self, op):
+        return 0
+
+    def code(self, co):
+        # the instructions as written by replace(co_code=...)
+        return co.co_code
+
+    def backward(self, op):
+        return False
+
+    def jump_target(self, op, arg, offset):
+        if op in dis.hasjabs:
+            return arg * self.unit
+        base = offset + 2 + 2 * self.caches(op)
+        if self.backward(op):
+            return base - arg * self.unit
+        return base + arg * self.unit
+
+    def glued(self, prev, op):
+        # no padding may go between prev and op
+        return prev == dis.EXTENDED_ARG or op == CACHE
+
+    def line_table(self, lines, firstlineno, size):
+        table = bytearray()
+        lineno, index = firstlineno, None
+        for offset, line in lines:
+            # negative line number deltas result in invalid utf-8
+            if line <= lineno or offset == index:
+                continue
+            lineinc = line - lineno
+            idxinc = offset - (index or 0)
+            while idxinc > 127:
+                table.extend((127, 0))
+                idxinc -= 127
+            # the first line increment goes with the offset, or it would
+            # count for the instructions before
+            while lineinc > 127:
+                table.extend((idxinc, 127))
+                idxinc = 0
+                lineinc -= 127
+            table.extend((idxinc, lineinc))
+            lineno, index = line, offset
+        # so is their length, and pairs of zeros change nothing
+        while invalidu32(len(table)):
+            table.extend((0, 0))
+        return bytes(table)
+
+    def exception_table(self, co, new_offset):
+        return None
+
+    def exception_entries(self, co):
+        return []
+
+    def code_header(self, co):
+        return self.header.pack(b'c', co.co_argcount, co.co_posonlyargcount,
+                                co.co_kwonlyargcount, co.co_nlocals,
+                                co.co_stacksize, co.co_flags)
+
+    def code_fields(self, co, lines):
+        # what marshal writes after the header, in order
+        return [
+            ('co_code', self.code(co)),
+            ('co_consts', co.co_consts),
+            ('co_names', co.co_names),
+            ('co_varnames', co.co_varnames),
+            ('co_freevars', co.co_freevars),
+            ('co_cellvars', co.co_cellvars),
+            ('co_filename', co.co_filename),
+            ('co_name', co.co_name),
+            ('co_firstlineno', co.co_firstlineno),
+            (self.line_field, lines),
+        ]
+
+
+class Backend310(Backend):
+    # jumps count instructions, and co_linetable gives each range of
+    # bytes its line, relative to the one before
+    unit = 2
+    line_field = 'co_linetable'
+    code_pad = (NOP, ANY_ASCII)
+
+    def line_table(self, lines, firstlineno, size):
+        table = bytearray()
+        lineno = firstlineno
+        for start, end, line in line_ranges(lines, firstlineno, size,
+                                            self.increasing):
+            delta = line - lineno
+            while delta > 127:
+                table.extend((0, 127))
+                delta -= 127
+            length = end - start
+            while True:
+                # any byte delta up to 254 would do, if it were ASCII
+                chunk = min(length, 126)
+                table.extend((chunk, delta))
+                delta = 0
+                length -= chunk
+                if not length:
+                    break
+            lineno = line
+        while invalidu32(len(table)):
+            table.extend((0, 0))
+        return bytes(table)
+
+
+class Backend311(Backend310):
+    # inline caches follow many instructions, jumps may go backwards,
+    # and there are location and exception tables; every entry of both
+    # starts with a byte above 0x7f followed by ASCII, so neither can
+    # be valid UTF-8 unless it is empty
+    increasing = False
+    tables = ('co_consts',)
+    header = struct.Struct('<c5I')
+    glue = {('YIELD_VALUE', 'RESUME'),
+            # specialized PRECALLs skip the CALL right after them
+            ('PRECALL', 'CALL')}
+
+    def caches(self, op):
+        return dis._inline_cache_entries[op]
+
+    def backward(self, op):
+        return 'JUMP_BACKWARD' in dis.opname[op]
+
+    def code(self, co):
+        # co_code has the caches zeroed, and so would lose the lead bytes
+        # in them; transcoded code objects never run, so are not quickened
+        return co._co_code_adaptive
+
+    def glued(self, prev, op):
+        return super().glued(prev, op) or prev is not None and (
+            dis.opname[prev], dis.opname[op]) in self.glue
+
+    def line_table(self, lines, firstlineno, size):
+        # line numbers only, 8 instructions per entry at most
+        table = bytearray()
+        lineno = firstlineno
+        for start, end, line in line_ranges(lines, firstlineno, size,
+                                            self.increasing):
+            units = (end - start) // 2
+            while units > 0:
+                count = min(units, 8)
+                table.append(0x80 | 13 << 3 | count - 1)
+                delta = line - lineno
+                value = -delta << 1 | 1 if delta < 0 else delta << 1
+                while value >= 0x40:
+                    table.append(0x40 | value & 0x3f)
+                    value >>= 6
+                table.append(value)
+                lineno = line
+                units -= count
+        return bytes(table)
+
+    def exception_table(self, co, new_offset):
+        table = bytearray()
+        for entry in self.exception_entries(co):
+            start = new_offset(entry.start)
+            values = (start // 2, (new_offset(entry.end) - start) // 2,
+                      new_offset(entry.target) // 2,
+                      entry.depth << 1 | entry.lasti)
+            for n, value in enumerate(values):
+                chunks = [value & 0x3f]
+                while value >= 0x40:
+                    value >>= 6
+                    chunks.append(0x40 | value & 0x3f)
+                chunks.reverse()
+                if not n:
+                    chunks[0] |= 0x80
+                table.extend(chunks)
+        return bytes(table)
+
+    def exception_entries(self, co):
+        return dis._parse_exception_table(co)
+
+    def localsplus(self, co):
+        cells = set(co.co_cellvars)
+        extra = tuple(name for name in co.co_cellvars
+                      if name not in co.co_varnames)
+        kinds = bytes([CO_FAST_LOCAL | (CO_FAST_CELL if name in cells else 0)
+                       for name in co.co_varnames]
+                      + [CO_FAST_CELL] * len(extra)
+                      + [CO_FAST_FREE] * len(co.co_freevars))
+        return co.co_varnames + extra + co.co_freevars, kinds
+
+    def code_header(self, co):
+        return self.header.pack(b'c', co.co_argcount, co.co_posonlyargcount,
+                                co.co_kwonlyargcount, co.co_stacksize,
+                                co.co_flags)
+
+    def code_fields(self, co, lines):
+        names, kinds = self.localsplus(co)
+        return [
+            ('co_code', self.code(co)),
+            ('co_consts', co.co_consts),
+            ('co_names', co.co_names),
+            ('co_localsplusnames', names),
+            ('co_localspluskinds', kinds),
+            ('co_filename', co.co_filename),
+            ('co_name', co.co_name),
+            ('co_qualname', co.co_qualname),
+            ('co_firstlineno', co.co_firstlineno),
+            (self.line_field, lines),
+            ('co_exceptiontable', co.co_exceptiontable),
+        ]
+
+
+# kinds of co_localsplusnames in 3.11
+CO_FAST_LOCAL = 0x20
+CO_FAST_CELL = 0x40
+CO_FAST_FREE = 0x80
+
+if sys.version_info >= (3, 11):
+    BACKEND = Backend311()
+elif sys.version_info >= (3, 10):
+    BACKEND = Backend310()
+else:
+    BACKEND = Backend()
+
+
+class Stream:
+    # the logical instructions of a code object in parallel columns, with
+    # EXTENDED_ARG prefixes folded into the instructions they extend;
+    # starts is where the first prefix is, offsets where the opcode is,
+    # lines is -1 where no line starts and labels flags jump targets
+    def __init__(self, co):
+        self.ops = array('B')
+        self.args = array('I')
+        self.offsets = array('I')
+        self.starts = array('I')
+        self.lines = array('i')
+        self.labels = array('B')
+        linestarts = dict(dis.findlinestarts(co))
+        code = self.code = co.co_code
+        arg, start, line, skip = 0, None, -1, 0
+        # a last odd byte, as in code padded to an encodable length on 3.9,
+        # is never run
+        for offset in range(0, len(code) - 1, 2):
+            if skip:
+                skip -= 1
+                continue
+            if start is None:
+                start = offset
+            if line < 0:
+                line = linestarts.get(offset, -1)
+            op = code[offset]
+            arg |= code[offset + 1]
+            if op == dis.EXTENDED_ARG:
+                arg <<= 8
+                continue
+            self.ops.append(op)
+            # unlike in stock dis of 3.9, prefixes of an instruction
+            # without an arg do not carry over to the next one
+            self.args.append(arg if op >= dis.HAVE_ARGUMENT else 0)
+            self.offsets.append(offset)
+            self.starts.append(start)
+            self.lines.append(line)
+            skip = BACKEND.caches(op)
+            arg, start, line = 0, None, -1
+
+        self.labels.extend(bytes(len(self.ops)))
+        for i, op in enumerate(self.ops):
+            if is_jump(op):
+                self.labels[self.target(i)] = 1
+
+    def __len__(self):
+        return len(self.ops)
+
+    def index(self, offset):
+        # the instruction whose bytes, prefixes included, contain offset
+        return bisect_right(self.starts, offset) - 1
+
+    def arg(self, i):
+        return self.args[i] if self.ops[i] >= dis.HAVE_ARGUMENT else None
+
+    def target(self, i):
+        return self.index(BACKEND.jump_target(
+            self.ops[i], self.args[i], self.offsets[i]))
+
+    def landings(self):
+        # the instructions that are not NOPs, and for every offset a jump
+        # may go to, how many of those come before where it lands; that
+        # is where an instruction starts, or past prefixes that do not
+        # change its arg: zero ones, or any of a NOP
+        reals = [i for i, op in enumerate(self.ops) if op != NOP]
+        land = {}
+        n = len(reals)
+        for i in range(len(self.ops) - 1, -1, -1):
+            nop = self.ops[i] == NOP
+            n -= not nop
+            offset = self.starts[i]
+            land[offset] = n
+            while offset < self.offsets[i] and (
+                    nop or not self.code[offset + 1]):
+                offset += 2
+                land[offset] = n
+        return reals, land
+
+    def line_of(self, firstlineno, increasing=False):
+        # the line of every instruction, as the last line start before it,
+        # or the greatest one if line numbers cannot go back
+        lines = array('i')
+        line = firstlineno
+        for start in self.lines:
+            if start >= 0:
+                line = max(line, start) if increasing else start
+            lines.append(line)
+        return lines
+
+
+class Block:
+    def __init__(self, first, end):
+        self.first = first
+        self.end = end
+        self.code = []
+        self.places = []
+        self.lines = []
+        self.spans = []
+        self.size = 0
+        self.lead = 0
+        self.error = None
 
 
 class Transcoder:
-    def __init__(self, codeobj, force=False, verbose=False):
-        self.bcode = dis.Bytecode(codeobj)
-        self.places = {}
+    max_relax = 1024
+    max_lead = 64
+
+    def __init__(self, codeobj, force=False, verbose=False, counts=None):
         self.newcode = []
         self.codeobj = codeobj
         self.force = force
         self.verbose = verbose
-        self.state = U8.ascii
-        self.was_extended_arg = False
-        self.nextcode = list(self.bcode)[1:]
-        self.lnotab = bytearray()
-        self.lineno = codeobj.co_firstlineno
-        self.index = 0
-
-    def maybe_insert_cont(self):
-        if self.was_extended_arg:
-            print('Warn: insert after ext arg would change semantics (1)')
-        elif self.state == U8.start2:
-            self.newcode.extend((dis.EXTENDED_ARG, 0))
-            self.state = U8.ascii
-        elif self.state == U8.start3:
-            self.newcode.extend((dis.EXTENDED_ARG, 0x80))
-            self.state = U8.cont
-            self.need_ignore = True
-        elif self.state == U8.start4:
-            self.newcode.extend((dis.EXTENDED_ARG, 0x80,
-                                 dis.EXTENDED_ARG, None))
-            self.state = U8.ascii
-            self.need_ignore = True
-
-    def maybe_insert_start(self, val, instr):
-        if self.newcode[-1:] == [None]:
-            self.newcode[-1] = val
-        elif self.was_extended_arg:
-            print('Warn: insert after ext arg would change semantics (2)')
-            val = ANY_ASCII
-        else:
-            self.newcode.extend((dis.opmap['NOP'], val))
-            self.need_ignore = False
-        self.state = u8char(val).type
-
-    def process(self, x, nextx):
-        opcode, arg, nextopcode, nextarg = map(
-            u8char,
-            (x.opcode, x.arg, nextx.opcode, nextx.arg)
-        )
-
-        # if we are recursive
-        if arg and arg >= 256:
-            self.process(mk_extended_arg(arg >> 8, x), x)
-            arg = u8char(arg % 256)
-
-        need_close = (self.state >= U8.start2 and not opcode.cont
-                      or self.state >= U8.start3 and not arg.cont
-                      or self.state == U8.start2 and arg.cont
-                      or self.state == U8.start4 and not nextopcode.cont
-                      and opcode == dis.EXTENDED_ARG)
-        self.need_ignore = False
-
-        if self.verbose > 2:
-            print(f'{x=}, {self.state=}, {need_close=}')
-
-        if need_close and self.state >= U8.start2:
-            self.maybe_insert_cont()
-
-        # thankfully all opcodes are currently < 0xc0
-        if opcode.cont and self.state < U8.start2:
-            val = 0xc3
-            if arg.cont:
-                val = 0xe1  # escape arg as well
-                if nextopcode.cont and not nextarg.cont:
-                    val = 0xf1  # escape next opcode as well
-            self.maybe_insert_start(val, x)
-
-        if self.need_ignore and opcode >= dis.HAVE_ARGUMENT:
-            if self.newcode[-1] is None:
-                self.newcode[-1] = ANY_ASCII
-            self.newcode.extend((dis.opmap['NOP'], None))
-
-        if self.newcode[-1:] == [None]:
-            self.newcode[-1] = ANY_ASCII
-
-        self.newcode.extend((opcode, arg))
-
-        self.was_extended_arg = opcode == dis.EXTENDED_ARG
-
-        if opcode.ascii and arg and arg.cont:
-            print('Warn: opcode is low and arg is '
-                  f'0x80 <= {arg:#02x} < 0xc2')
-            if self.verbose > 1:
-                dis.disassemble(self.codeobj, x.offset)
-
-        if not arg:
-            self.state = U8.ascii
-        elif arg.start:
-            self.state = arg.type
-        elif opcode.start:  # impossible
-            self.state = opcode.type - 1
-        elif self.state >= U8.start2:
-            self.state -= 2
-
-    def fixjump(self, x):
-        _, pl = self.places[x.offset]
-        vmin, vmax = self.places[x.argval]
-        if x.opcode in dis.hasjrel:
-            vmin -= pl + 2
-            vmax -= pl + 2
-        if x.arg < vmin:
-            v = vmin
-        elif x.arg > vmax:
-            v = vmax
-        else:
-            return
-
-        oldrep = x.arg.to_bytes(4, 'little')
-        newrep = v.to_bytes(4, 'little')
-        while True:
-            self.newcode[pl + 1] = newrep[0]
-            oldrep = oldrep[1:]
-            newrep = newrep[1:]
-            if oldrep == newrep:
-                break
-            if not any(oldrep):
-                if self.verbose:
-                    print('need new EXTENDED_ARG for '
-                          f'{self.codeobj.co_name} in '
-                          f'{self.codeobj.co_filename}'
-                          f':{self.codeobj.co_firstlineno}')
-                assert not any(newrep[1:])
-                self.newcode[pl + 1] |= newrep[0] << 8
-                break
-            pl -= 2
-            assert self.newcode[pl] == dis.EXTENDED_ARG
-
-    def adjumps(self):
-        for x in self.bcode:
-            if x.opcode in dis.hasjrel or x.opcode in dis.hasjabs:
-                self.fixjump(x)
+        self.args = {}
+        self.starts = []
+        self.rounds = 0
+        self.repairs = 0
+        self.times = {}
+        self.orders = {}
+        clock = time.perf_counter()
+        self.stream = Stream(codeobj)
+        self.widths = array('B', bytes(len(self.stream)))
+        # how often each instruction ran in the profile, on a log scale;
+        # padding in front of it costs 1 + heat
+        counts = counts or {}
+        self.heat = array('B', [counts.get(start, 0).bit_length()
+                                for start in self.stream.starts])
+        self.reindex()
+        self.blocks = self.split_blocks()
+        self.block_of = array('I', bytes(4 * len(self.stream)))
+        for i, block in enumerate(self.blocks):
+            self.block_of[block.first:block.end] = array(
+                'I', [i] * (block.end - block.first))
+        self.times['split'] = time.perf_counter() - clock
+        self.result = None
+        self.stats = None
+
+    def reindex(self):
+        # give the most used constants, names and locals the indexes that
+        # need the least padding; the docstring and arguments stay put.
+        # No padding helps an ASCII opcode with an arg in 0x80..0xc1, so
+        # unused fillers take those slots, unless there are entries that
+        # only LOAD_METHOD uses
+        co = self.codeobj
+        ops, args = self.stream.ops, self.stream.args
+        nargs = (co.co_argcount + co.co_kwonlyargcount
+                 + bool(co.co_flags & CO_VARARGS)
+                 + bool(co.co_flags & CO_VARKEYWORDS))
+        remap = {}
+        for field, hasop, fixed in (('co_consts', dis.hasconst, 1),
+                                    ('co_names', dis.hasname, 0),
+                                    ('co_varnames', dis.haslocal, nargs)):
+            if field not in BACKEND.tables:
+                continue
+            size = len(getattr(co, field))
+            if size <= 0x80:
+                continue
+            uses = Counter((args[i], stuck_byte(op, 0x80))
+                           for i, op in enumerate(ops) if op in hasop)
+            olds = sorted(range(fixed, size), key=lambda i: (
+                -uses[i, True], -uses[i, False]))
+            needed = sum(uses[i, True] > 0 for i in olds)
+            good = sum(slot_cost(i)[0] is False for i in range(fixed, size))
+            total = size
+            # the tuple length has to be encodable too, which no length
+            # in 0x80..0xff is
+            while good < needed or invalidu32(total):
+                good += slot_cost(total)[0] is False
+                total += 1
+            olds += [None] * (total - size)
+
+            order = list(range(fixed)) + [None] * (total - fixed)
+            for new, old in zip(sorted(range(fixed, total), key=slot_cost),
+                                olds):
+                order[new] = old
+            if order == list(range(size)):
+                continue
+            self.orders[field] = tuple(order)
+            for new, old in enumerate(order):
+                for op in hasop:
+                    remap[op, old] = new
+
+        for i, op in enumerate(ops):
+            args[i] = remap.get((op, args[i]), args[i])
+
+    def split_blocks(self):
+        ops, labels = self.stream.ops, self.stream.labels
+        leaders = {0, len(ops)}
+        for i, op in enumerate(ops):
+            if labels[i]:
+                leaders.add(i)
+            if is_jump(op):
+                leaders.add(i + 1)
+        leaders = sorted(leaders)
+        return [Block(first, end) for first, end in zip(leaders, leaders[1:])]
+
+    def plan(self, pairs, tail=1):
+        # the fewest padding instructions that make pairs valid UTF-8,
+        # a shortest path through the decoder states between pairs where
+        # gap allows padding; padding counts weight times before each pair
+        # and tail times after the last one.  Every layer maps
+        # (state, pending) to (cost, trail)
+        layer = {(0, False): (0, None)}
+        for op, arg, gap, weight in pairs:
+            args = (arg,)
+            new = {}
+            for key, (cost, trail) in layer.items():
+                for after, pads, errors in routes(key, op, gap):
+                    if arg is None:
+                        args = free_bytes(after,
+                                          0 if op == CACHE else ANY_ASCII)
+                    for a in args:
+                        state = NEXT_STATE[after][a]
+                        c = cost + errors + len(pads) // 2 * weight
+                        if state == BAD_STATE:
+                            state = recover(a)
+                            c += ERROR_COST
+                        old = new.get((state, False))
+                        if old is None or c < old[0]:
+                            new[state, False] = c, (trail, pads, op, a)
+            layer = new
+
+        # end every block in a clean state, so that blocks can be
+        # emitted and moved around independently of each other
+        best = None
+        for key, (cost, trail) in layer.items():
+            pads = pad_closure(key).get((0, False))
+            if pads is None:
+                pads, cost = (), cost + ERROR_COST
+            cost += len(pads) // 2 * tail
+            if best is None or cost < best[0]:
+                best = cost, pads, trail
+
+        _, tail, trail = best
+        steps = []
+        while trail is not None:
+            trail, pads, op, arg = trail
+            steps.append((pads, op, arg))
+        steps.reverse()
+        return steps, tail
+
+    def emit_block(self, block):
+        pairs = []
+        firsts = []
+        prev = None
+        for i in range(block.first, block.end):
+            opcode, oparg = self.stream.ops[i], self.resolve(i)
+            # jumps only ever get wider, or relative ones could flip
+            # between two widths forever
+            count = ext_count(oparg)
+            width = max(self.widths[i], count)
+            if is_jump(opcode):
+                self.widths[i] = width
+            firsts.append(len(pairs))
+            weight = 1 + self.heat[i]
+            ops = [(dis.EXTENDED_ARG, 0)] * (width - count)
+            for shift in range(count, 0, -1):
+                ops.append((dis.EXTENDED_ARG, oparg >> 8 * shift & 0xff))
+            ops.append((opcode, None if oparg is None else oparg & 0xff))
+            # the high byte of a cache entry is free as well, a lead byte
+            # there only delays specializing the instruction for a while
+            ops.extend([(CACHE, None)] * BACKEND.caches(opcode))
+            for op, arg in ops:
+                pairs.append((op, arg, not BACKEND.glued(prev, op), weight))
+                prev = op
+            prev = opcode
+
+        # padding after the last instruction only runs when it falls
+        # through, and never after a jump or return
+        last = block.end - 1
+        steps, tail = self.plan(pairs, 1 if self.stream.ops[last] in STOPS
+                                else 1 + self.heat[last])
+        # lead padding moves the block away from unencodable jump args,
+        # and jumping into it is as good as jumping to the first instruction
+        code = [NOP, ANY_ASCII] * block.lead
+        offsets = []
+        for pads, op, arg in steps:
+            offsets.append(len(code))
+            code.extend(pads)
+            code.extend((op, arg))
+        code.extend(tail)
+
+        block.places = []
+        block.lines = []
+        block.spans = []
+        for n, first in enumerate(firsts):
+            minoff = offsets[first] if n else 0
+            block.spans.append(minoff)
+            line = self.stream.lines[block.first + n]
+            if line >= 0:
+                block.lines.append((minoff, line))
+            # jumping past our own EXTENDED_ARGs would change the arg
+            block.places.append((minoff, offsets[first] + len(
+                steps[first][0])))
+
+        # blocks never shrink, so relaxation always reaches a fixed point
+        while len(code) < block.size:
+            code.extend((NOP, ANY_ASCII))
+        block.code = code
+        block.size = len(code)
+        block.error = first_invalid(code)
+
+    def resolve(self, i):
+        # the arg of instruction i, as the jumps have settled so far
+        arg = self.args.get(i)
+        if arg is None:
+            return self.stream.arg(i)
+        return arg
+
+    def place(self, i, starts):
+        index = self.block_of[i]
+        block = self.blocks[index]
+        vmin, vmax = block.places[i - block.first]
+        return starts[index] + vmin, starts[index] + vmax
+
+    def fixjump(self, i, starts):
+        opcode = self.stream.ops[i]
+        _, pl = self.place(i, starts)
+        pl += 2 * self.widths[i]
+        vmin, vmax = self.place(self.stream.target(i), starts)
+        backward = BACKEND.backward(opcode)
+        if opcode in dis.hasjrel:
+            base = pl + 2 + 2 * BACKEND.caches(opcode)
+            if backward:
+                vmin, vmax = base - vmax, base - vmin
+            else:
+                vmin, vmax = vmin - base, vmax - base
+            vmin = max(vmin, 0)
+        assert vmax >= 0, 'relative jump backwards'
+        vmin //= BACKEND.unit
+        vmax //= BACKEND.unit
+
+        arg = self.resolve(i)
+        hot = self.heat[i] > 0
+
+        def cost(v):
+            # prefer encodable bytes, then the least EXTENDED_ARGs and
+            # an ASCII low byte, then for jumps that run at all, landing
+            # past the padding in front of the target
+            stuck = stuck_byte(opcode, v & 0xff) or any(
+                stuck_byte(dis.EXTENDED_ARG, v >> 8 * i & 0xff)
+                for i in range(1, ext_count(v) + 1))
+            padding = hot and (v - vmin if backward else vmax - v)
+            return (stuck, ext_count(v), byte_cost(v & 0xff), padding,
+                    abs(v - arg))
+
+        best = min(range(vmin, vmax + 1, 2 // BACKEND.unit), key=cost)
+        if vmin <= arg <= vmax and cost(arg)[:4] <= cost(best)[:4]:
+            return None
+        return best
+
+    def locate(self, block, offset):
+        # the instruction whose bytes contain offset within block
+        return block.first + bisect_right(block.spans, offset) - 1
+
+    def repair(self):
+        # an ASCII jump opcode followed by a continuation byte cannot be
+        # fixed by padding around it, so move the target out of the way;
+        # only the first target is moved each time, as that shifts all
+        # the others anyway
+        fixes = []
+        for block in self.blocks:
+            if block.error is None:
+                continue
+            offset, state = block.error
+            i = self.locate(block, offset)
+            opcode = self.stream.ops[i]
+            if not is_jump(opcode) or char_type(opcode) != ASCII:
+                continue
+            if offset != block.places[i - block.first][1] + 2 * self.widths[
+                    i] + 1:
+                continue
+
+            arg = self.resolve(i)
+            pad = 1
+            while byte_cost((arg + pad * 2 // BACKEND.unit) & 0xff) > 1:
+                pad += 1
+
+            index = self.block_of[self.stream.target(i)]
+            if self.blocks[index].lead + pad <= self.max_lead:
+                fixes.append((index, pad))
+
+        if not fixes:
+            return set()
+        index, pad = min(fixes)
+        self.blocks[index].lead += pad
+        return {index}
+
+    def report(self):
+        for start, block in zip(self.starts, self.blocks):
+            if block.error is None:
+                continue
+            offset, state = block.error
+            i = self.locate(block, offset)
+            print(f'Invalid UTF-8 in {self.codeobj.co_name} at '
+                  f'{start + offset} ({state.name}), from '
+                  f'{dis.opname[self.stream.ops[i]]} '
+                  f'at {self.stream.offsets[i]} in '
+                  f'{self.codeobj.co_filename}')
+
+    def relax(self):
+        for block in self.blocks:
+            self.emit_block(block)
+
+        for self.rounds in range(1, self.max_relax + 1):
+            starts = [0]
+            for block in self.blocks:
+                starts.append(starts[-1] + block.size)
+
+            changed = set()
+            for index, block in enumerate(self.blocks):
+                for i in range(block.first, block.end):
+                    if not is_jump(self.stream.ops[i]):
+                        continue
+                    arg = self.fixjump(i, starts)
+                    if arg is not None:
+                        self.args[i] = arg
+                        changed.add(index)
+
+            if not changed:
+                changed = self.repair()
+                self.repairs += bool(changed)
+            if not changed:
+                self.starts = starts
+                return starts
 
-    def record_lineno(self, lineno):
-        index = len(self.newcode)
-        if lineno is None or lineno == self.lineno or index == self.index:
-            return
-        lineinc = lineno - self.lineno
-        idxinc = index - self.index
-        if lineinc < 0:
-            # negative line number deltas result in invalid utf-8
-            return
-        while lineinc > 127:
-            self.lnotab.extend((0, 127))
-            lineinc -= 127
-        while idxinc > 127:
-            self.lnotab.extend((127, 0))
-            idxinc -= 127
-        self.lnotab.extend((idxinc, lineinc))
-        self.index = index
-        self.lineno = lineno
-
-    def transcode(self, can_recurse=False):
-        for x, nextx in zip_longest(self.bcode, self.nextcode,
-                                    fillvalue=empty_instr):
-            minoff = len(self.newcode)
-            self.record_lineno(x.starts_line)
-            if x.opcode != dis.EXTENDED_ARG:
-                self.process(x, nextx)
-            maxoff = len(self.newcode)
-            if maxoff > minoff:
-                maxoff -= 2
-            self.places[x.offset] = minoff, maxoff
-
-        if self.newcode[-1:] == [None]:
-            self.newcode[-1] = ANY_ASCII
-
-        self.adjumps()
-
-        if (any(x >= 256 for x in self.newcode) or invalid(
-                bytes(self.newcode), self.verbose > 1)) and can_recurse:
             if self.verbose:
-                print(f"Invalid code {self.codeobj.co_name} detected, "
-                      f"retrying ({len(self.newcode)=})")
-                if self.verbose > 1:
-                    hexdump(self.newcode)
-            return Transcoder(
-                CodeWrapper(self.codeobj, co_code=self.newcode,
-                            co_lnotab=self.lnotab),
-                self.force,
-                self.verbose).transcode(can_recurse - 1)
+                print(f'Relaxing {len(changed)} blocks of '
+                      f'{self.codeobj.co_name}')
+            for i in sorted(changed):
+                self.emit_block(self.blocks[i])
+
+        raise ValueError(f'jumps in {self.codeobj.co_name} in '
+                         f'{self.codeobj.co_filename}'
+                         f':{self.codeobj.co_firstlineno} did not settle')
+
+    def new_offset(self, starts, offset):
+        # where the instruction at offset starts now, padding included
+        if offset >= len(self.codeobj.co_code):
+            return starts[-1]
+        return self.place(self.stream.index(offset), starts)[0]
+
+    def transcode(self):
+        clock = time.perf_counter()
+        starts = self.relax()
+        self.times['relax'] = time.perf_counter() - clock
+
+        clock = time.perf_counter()
+        self.newcode = []
+        lines = []
+        # blocks were only checked one by one, so the whole code is checked
+        # again as it is put together
+        validator = Validator()
+        for start, block in zip(starts, self.blocks):
+            self.newcode.extend(block.code)
+            validator.feed(block.code)
+            for offset, lineno in block.lines:
+                lines.append((start + offset, lineno))
+
+        if self.verbose:
+            self.report()
 
         # adjust code length
         while invalidu32(len(self.newcode)):
-            self.newcode.append(ANY_ASCII)
+            self.newcode.extend(BACKEND.code_pad)
+            validator.feed(BACKEND.code_pad)
         newcode = bytes(self.newcode)
 
-        # adjust stacksize
-        co_stacksize = maybe_bigger(self.codeobj.co_stacksize)
-
-        codeobj = self.codeobj.replace(co_code=newcode,
-                                       co_lnotab=bytes(self.lnotab),
-                                       co_stacksize=co_stacksize)
+        fields = {
+            'co_code': newcode,
+            BACKEND.line_field: BACKEND.line_table(
+                lines, self.codeobj.co_firstlineno, len(newcode)),
+            # adjust stacksize
+            'co_stacksize': maybe_bigger(self.codeobj.co_stacksize),
+        }
+        table = BACKEND.exception_table(self.codeobj, functools.partial(
+            self.new_offset, starts))
+        if table is not None:
+            fields['co_exceptiontable'] = table
+
+        self.result = fields, self.orders
+        codeobj = rebuild(self.codeobj, *self.result)
+        self.times['assemble'] = time.perf_counter() - clock
+        self.stats = self.collect_stats(codeobj)
         if self.verbose:
             if self.verbose > 1:
                 dis.dis(codeobj)
@@ -277,11 +893,330 @@ class Transcoder:
             if self.verbose > 1:
                 hexdump(newcode)
 
-        # make sure UTF-8 magic really worked
-        assert self.force or newcode.decode()
+        # make sure UTF-8 magic really worked; failing that, it is the same
+        # error as for any other field that is not valid UTF-8
+        if not self.force and not validator.close():
+            raise UnicodeDecodeError(
+                'utf-8', newcode, validator.error, validator.error + 1,
+                f'no valid UTF-8 in co_code of {self.codeobj.co_name}')
 
         return codeobj
 
+    def collect_stats(self, codeobj):
+        old, new = self.codeobj, codeobj
+        newcode = BACKEND.code(new)
+        oldops, newops = old.co_code[::2], newcode[::2]
+        stream = self.stream
+        widened = sum(width > ext_count(stream.arg(i))
+                      for i, width in enumerate(self.widths))
+
+        # inserted instructions go to the source line of the instruction
+        # whose span they are in
+        lines = Counter()
+        lineno = old.co_firstlineno
+        for block in self.blocks:
+            ends = block.spans[1:] + [block.size]
+            for i, begin, end in zip(range(block.first, block.end),
+                                     block.spans, ends):
+                if stream.lines[i] >= 0:
+                    lineno = stream.lines[i]
+                inserted = ((end - begin) // 2 - 1 - ext_count(stream.arg(i))
+                            - BACKEND.caches(stream.ops[i]))
+                if inserted:
+                    lines[lineno] += inserted
+
+        return {
+            'name': old.co_name,
+            'filename': old.co_filename,
+            'firstlineno': old.co_firstlineno,
+            'size': len(old.co_code),
+            'new_size': len(newcode),
+            'nops': newops.count(NOP) - oldops.count(NOP),
+            'extended_args': (newops.count(dis.EXTENDED_ARG)
+                              - oldops.count(dis.EXTENDED_ARG)),
+            'rounds': self.rounds,
+            'repairs': self.repairs,
+            'widened': widened,
+            'stacksize': old.co_stacksize,
+            'new_stacksize': new.co_stacksize,
+            'valid': not invalid(newcode),
+            'time': dict(self.times),
+            'lines': dict(sorted(lines.items())),
+        }
+
+
+# instructions that never go on to the next one
+STOPS = {dis.opmap[name] for name in (
+    'RETURN_VALUE', 'RAISE_VARARGS', 'RERAISE', 'JUMP_ABSOLUTE',
+    'JUMP_FORWARD', 'JUMP_BACKWARD', 'JUMP_BACKWARD_NO_INTERRUPT')
+    if name in dis.opmap}
+
+
+def same_value(a, b):
+    # table entries as equal as they can be after going through marshal
+    return a is b or type(a) is type(b) and (a == b or repr(a) == repr(b))
+
+
+def verify(old, new):
+    # check that new, transcoded from old, does the same without running
+    # either: with NOPs dropped, they have the same instructions with the
+    # same args, table entries compared by value, jumps landing on the
+    # same instruction, the same lines and exception table, and nothing
+    # after the end that can be reached; instructions being the same,
+    # so are their stack effects. Takes time linear in the code size,
+    # and raises ValueError at the first difference
+    where = f'{old.co_name} in {old.co_filename}:{old.co_firstlineno}'
+    for field in ('co_argcount', 'co_posonlyargcount', 'co_kwonlyargcount',
+                  'co_flags', 'co_freevars', 'co_cellvars',
+                  'co_firstlineno'):
+        if getattr(old, field) != getattr(new, field):
+            raise ValueError(f'{field} of {where} changed')
+    if new.co_stacksize < old.co_stacksize:
+        raise ValueError(f'co_stacksize of {where} shrank')
+
+    a, b = Stream(old), Stream(new)
+    areals, aland = a.landings()
+    breals, bland = b.landings()
+    aland[len(old.co_code)] = len(areals)
+    bland[len(new.co_code)] = len(breals)
+    blines = b.line_of(new.co_firstlineno)
+
+    def lands(land, offset):
+        if offset not in land:
+            raise ValueError(f'no instruction starts at {offset} of {where}')
+        return land[offset]
+
+    def value(co, op, arg):
+        for field, ops in (('co_consts', dis.hasconst),
+                           ('co_names', dis.hasname),
+                           ('co_varnames', dis.haslocal)):
+            if field in BACKEND.tables and op in ops:
+                return getattr(co, field)[arg]
+        return arg
+
+    if len(breals) < len(areals):
+        raise ValueError(f'{where} lost instructions')
+    alines = a.line_of(old.co_firstlineno, BACKEND.increasing)
+    for i, j in zip(areals, breals):
+        op = a.ops[i]
+        at = f'{dis.opname[op]} at {a.offsets[i]} of {where}'
+        if b.ops[j] != op:
+            raise ValueError(f'{dis.opname[b.ops[j]]} instead of {at}')
+        if is_jump(op):
+            if lands(aland, BACKEND.jump_target(
+                    op, a.args[i], a.offsets[i])) != lands(
+                        bland, BACKEND.jump_target(op, b.args[j],
+                                                   b.offsets[j])):
+                raise ValueError(f'{at} jumps elsewhere')
+        elif op >= dis.HAVE_ARGUMENT:
+            try:
+                same = same_value(value(old, op, a.args[i]),
+                                  value(new, op, b.args[j]))
+            except IndexError:
+                same = False
+            if not same:
+                raise ValueError(f'{at} changed its arg')
+        if blines[j] != alines[i]:
+            raise ValueError(f'{at} went from line {alines[i]} '
+                             f'to {blines[j]}')
+
+    if len(breals) > len(areals) and a.ops[areals[-1]] not in STOPS:
+        raise ValueError(f'{where} runs on past its end')
+
+    # the ends of entries land on the instruction after them, if any
+    olds, news = ([(lands(land, e.start), lands(land, e.end),
+                    lands(land, e.target), e.depth, e.lasti)
+                   for e in BACKEND.exception_entries(co)]
+                  for co, land in ((old, aland), (new, bland)))
+    if olds != news:
+        raise ValueError(f'exception table of {where} changed')
+
+
+class TranscodeCache:
+    def __init__(self, path, maxsize=64 << 20):
+        self.path = path
+        self.maxsize = maxsize
+
+    def key(self, co, force=False, counts=None):
+        # only what Transcoder actually looks at goes in, so that editing
+        # one function does not invalidate the functions around it
+        h = hashlib.sha256(MAGIC_NUMBER)
+        if counts:
+            h.update(marshal.dumps(sorted(counts.items())))
+        h.update(f'{__version__}:{force:d}:{co.co_firstlineno}:'
+                 f'{co.co_stacksize}:{co.co_argcount}:'
+                 f'{co.co_kwonlyargcount}:{co.co_flags}:'
+                 f'{len(co.co_consts)}:{len(co.co_names)}:'
+                 f'{len(co.co_varnames)}:'.encode())
+        h.update(marshal.dumps((co.co_code, getattr(co, BACKEND.line_field),
+                                getattr(co, 'co_exceptiontable', b''))))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, co, force=False, counts=None):
+        fname = self.filename(self.key(co, force, counts))
+        try:
+            with open(fname, 'rb') as fp:
+                newco = rebuild(co, *marshal.load(fp))
+            os.utime(fname)
+        except (OSError, EOFError, ValueError, TypeError, IndexError):
+            return None
+        return newco
+
+    def put(self, co, result, force=False, counts=None):
+        # result is what Transcoder.result holds after transcoding co
+        fname = self.filename(self.key(co, force, counts))
+        tmpname = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(tmpname, 'wb') as fp:
+                marshal.dump(result, fp)
+            os.replace(tmpname, fname)
+        except OSError:
+            pass
+
+    def trim(self):
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                fname = os.path.join(root, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+                total += st.st_size
+
+        # least recently used go first
+        entries.sort()
+        for _, size, fname in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(fname)
+            except OSError:
+                continue
+            total -= size
+
+
+class MemoryCache(TranscodeCache):
+    # the same, but in memory, for workers of utfpyc serve and threads
+    # sharing one
+    def __init__(self, maxsize=64 << 20):
+        super().__init__(None, maxsize)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def __reduce__(self):
+        # other processes start out empty rather than get a copy
+        return type(self), (self.maxsize,)
+
+    def get(self, co, force=False, counts=None):
+        key = self.key(co, force, counts)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                return None
+            self.entries.move_to_end(key)
+        return rebuild(co, *marshal.loads(data))
+
+    def put(self, co, result, force=False, counts=None):
+        key = self.key(co, force, counts)
+        data = marshal.dumps(result)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            self.trim()
+
+    def trim(self):
+        with self.lock:
+            while self.size > self.maxsize:
+                _, data = self.entries.popitem(last=False)
+                self.size -= len(data)
+
+
+U32 = struct.Struct('<I')
+S32 = struct.Struct('<i')
+ZERO32 = bytes(4)
+
+
+F64 = struct.Struct('<d')
+single_types = (type(None), bool, type, type(...))
+
+
+def pick(forms):
+    # the shortest encoding that is valid UTF-8 on its own, or failing
+    # that, the first one, for the final check to complain about
+    valid = [form for form in forms if not invalid(form)]
+    return min(valid or forms[:1], key=len)
+
+
+def long_form(i):
+    digits = []
+    n = abs(i)
+    while n:
+        digits.append(n & 0x7fff)
+        n >>= 15
+    size = len(digits) if i >= 0 else -len(digits)
+    return b'l' + S32.pack(size) + struct.pack(f'<{len(digits)}H', *digits)
+
+
+def float_form(code, f):
+    text = repr(f).encode()
+    return code + bytes((len(text),)) + text
+
+
+def set_order(s):
+    # string hashes differ from one process to the next, and so would
+    # the output if sets were written in iteration order
+    return sorted(s, key=lambda x: (type(x).__name__, repr(x)))
+
+
+def filler(field, index):
+    # an entry for a slot that nothing uses
+    return None if field == 'co_consts' else f'.pad{index}'
+
+
+def rebuild(co, fields, orders):
+    # co with the new fields, and its tables in the order
+    # Transcoder.reindex() gave them
+    tables = {field: tuple(filler(field, new) if old is None
+                           else getattr(co, field)[old]
+                           for new, old in enumerate(order))
+              for field, order in orders.items()}
+    if 'co_varnames' in tables:
+        tables['co_nlocals'] = len(tables['co_varnames'])
+    return co.replace(**fields, **tables)
+
+
+def code_tree(obj):
+    if isinstance(obj, CodeType):
+        yield obj
+        for const in obj.co_consts:
+            yield from code_tree(const)
+
+
+def without_code(co):
+    # nested code objects are transcoded on their own, and Transcoder
+    # never looks inside constants, so do not ship them around
+    return co.replace(co_consts=tuple(
+        None if isinstance(const, CodeType) else const
+        for const in co.co_consts))
+
+
+def _transcode_job(job):
+    data, force, verbose, counts = job
+    transcoder = Transcoder(marshal.loads(data), force, verbose, counts)
+    transcoder.transcode()
+    return transcoder.result, transcoder.stats
+
 
 class NorefMarshalDumper:
     single = {
@@ -292,78 +1227,1270 @@ class NorefMarshalDumper:
         ...: b'.',
     }
 
-    def __init__(self, fp, force=False, write_lnotab=True, verbose=0):
+    # FLAG_REF makes most type codes invalid UTF-8 or a lead byte that the
+    # following length cannot complete; 'Z' + a length in 0x80..0xbf is
+    # the exception, and also the only way to write such strings at all
+    ref_lengths = range(0x80, 0xc0)
+
+    def __init__(self, fp, force=False, write_lnotab=True, verbose=0,
+                 cache=None, refs=False, stats=None, workers=1,
+                 verify=False, profile=None, warnings=None):
         self.fp = fp
         self.verbose = verbose
         self.force = force
         self.write_lnotab = write_lnotab
+        self.cache = cache
+        self.refs = refs
+        self.stats = stats
+        self.workers = workers
+        self.verify = verify
+        self.profile = profile or {}
+        self.warnings = warnings
+        self.transcoded = {}
+        self.buf = bytearray()
+        self.offsets = []
+        self.fields = []
+        self.shared = {}
+        self.nrefs = 0
+
+    def clean(self, co):
+        # co comes out valid UTF-8 as it is, which transcoding could
+        # only make bigger
+        code = BACKEND.code(co)
+        lines = getattr(co, BACKEND.line_field) if self.write_lnotab else b''
+        return not (invalid(code) or invalidu32(len(code))
+                    or invalid(lines) or invalidu32(len(lines))
+                    or invalid(BACKEND.code_header(co))
+                    or getattr(co, 'co_exceptiontable', b'')
+                    or any(invalidu32(len(getattr(co, field)))
+                           for field in BACKEND.tables))
+
+    def transcode(self, co):
+        if self.clean(co):
+            newco, stats = co, None
+        elif id(co) in self.transcoded:
+            newco, stats = self.transcoded.pop(id(co))
+        else:
+            newco, stats = self.transcode_one(co)
+        if self.verify and newco is not co:
+            verify(co, newco)
+
+        if self.stats is None:
+            pass
+        elif stats is None:
+            self.stats.append({
+                'name': co.co_name,
+                'filename': co.co_filename,
+                'firstlineno': co.co_firstlineno,
+                'size': len(co.co_code),
+                'new_size': len(BACKEND.code(newco)),
+                'valid': not invalid(BACKEND.code(newco)),
+                'cached': newco is not co,
+                'skipped': newco is co,
+            })
+        else:
+            self.stats.append(dict(stats, cached=False, skipped=False))
+        return newco
+
+    def counts(self, co):
+        return self.profile.get(profile_key(co))
+
+    def transcode_one(self, co):
+        # the new code object and its stats, None for cache hits
+        counts = self.counts(co)
+        newco = None
+        if self.cache is not None:
+            newco = self.cache.get(co, self.force, counts)
+        if newco is not None:
+            return newco, None
+
+        transcoder = Transcoder(co, self.force, self.verbose, counts)
+        newco = transcoder.transcode()
+        if self.cache is not None:
+            self.cache.put(co, transcoder.result, self.force, counts)
+        return newco, transcoder.stats
+
+    def transcode_all(self, obj):
+        # transcode the whole tree of code objects up front, over several
+        # processes; dump_code() then picks the results up in order
+        todo = []
+        for co in code_tree(obj):
+            if self.clean(co):
+                continue
+            newco = None
+            if self.cache is not None:
+                newco = self.cache.get(co, self.force, self.counts(co))
+            if newco is None:
+                todo.append(co)
+            else:
+                self.transcoded[id(co)] = newco, None
+        if len(todo) < 2:
+            return
 
-    def u32(self, i):
-        self.write(struct.pack('<I', i))
+        jobs = [(marshal.dumps(without_code(co)), self.force, self.verbose,
+                 self.counts(co)) for co in todo]
+        with ProcessPoolExecutor(self.workers or None) as pool:
+            results = pool.map(_transcode_job, jobs, chunksize=4)
+            for co, (result, stats) in zip(todo, results):
+                newco = rebuild(co, *result)
+                if self.cache is not None:
+                    self.cache.put(co, result, self.force, self.counts(co))
+                self.transcoded[id(co)] = newco, stats
+
+    def mark(self, field):
+        self.offsets.append(len(self.buf))
+        self.fields.append(field)
 
-    def s32(self, i):
-        self.write(struct.pack('<i', i))
+    def u32(self, i):
+        off = len(self.buf)
+        self.buf.extend(ZERO32)
+        U32.pack_into(self.buf, off, i)
 
     def u8(self, i):
-        self.write(struct.pack('<B', i))
+        self.buf.append(i)
 
     def write(self, bs):
+        self.buf += bs
+
+    def dump(self, obj, header=b''):
+        # the header of a pyc goes before obj, and is checked with it
+        self.buf = bytearray()
+        self.offsets = []
+        self.fields = []
+        if header:
+            self.mark('the pyc header')
+            self.write(header)
+            if not self.force and invalid(header):
+                # before transcoding anything for nothing
+                self.validate()
+        self.shared = self.plan_refs(obj) if self.refs else {}
+        self.nrefs = 0
+        self.transcoded = {}
+        if self.workers != 1:
+            self.transcode_all(obj)
+        self.put(obj)
         if not self.force:
-            bs.decode()
-        self.fp.write(bs)
-
-    def dump(self, obj):
-        if obj in self.single:
+            self.validate()
+        elif self.warnings is not None:
+            self.warnings.extend(self.invalid_fields())
+        self.fp.write(self.buf)
+
+    def field_at(self, offset):
+        # the field that the byte at offset belongs to, if any was marked
+        # before it, as objects other than code have none
+        i = bisect_right(self.offsets, offset) - 1
+        return self.fields[i] if i >= 0 else '<top level>'
+
+    def validate(self):
+        try:
+            codecs.utf_8_decode(memoryview(self.buf), None, True)
+        except UnicodeDecodeError as e:
+            field = self.field_at(e.start)
+            raise UnicodeDecodeError(e.encoding, e.object, e.start, e.end,
+                                     f'{e.reason} in {field}') from None
+
+    def invalid_fields(self):
+        # everything that validate() would complain about, not just the
+        # first thing, and each thing once
+        problems = []
+        view = memoryview(self.buf)
+        start = 0
+        while start < len(view):
+            try:
+                codecs.utf_8_decode(view[start:], None, True)
+                break
+            except UnicodeDecodeError as e:
+                problem = f'{e.reason} in {self.field_at(start + e.start)}'
+                if problem not in problems:
+                    problems.append(problem)
+                start += e.end
+        return problems
+
+    def can_ref(self, obj):
+        return (type(obj) is str and len(obj) in self.ref_lengths
+                and obj.isascii())
+
+    def plan_refs(self, obj):
+        counts = Counter()
+        todo = [obj]
+        while todo:
+            obj = todo.pop()
+            if self.can_ref(obj):
+                counts[obj] += 1
+            elif type(obj) is tuple:
+                todo.extend(obj)
+            elif type(obj) is CodeType:
+                todo.extend(value for _, value
+                            in BACKEND.code_fields(obj, b''))
+
+        return {s: None for s, n in counts.items() if n > 1}
+
+    def put(self, obj):
+        # not a plain lookup, as 1 == True and 0.0 == False
+        if type(obj) in single_types and obj in self.single:
             self.write(self.single[obj])
         else:
             getattr(self, 'dump_' + type(obj).__name__)(obj)
 
+    def dump_ref(self, s):
+        index = self.shared.get(s)
+        if index is not None and not invalidu32(index):
+            self.buf += b'r'
+            self.u32(index)
+            return
+
+        # the reader numbers flagged objects in the order it meets them
+        if s in self.shared:
+            self.shared[s] = self.nrefs
+        self.nrefs += 1
+        self.buf += b'\xda'  # 'Z' | FLAG_REF
+        self.u8(len(s))
+        self.buf += s.encode()
+
     def dump_int(self, i):
-        self.fp.write(b'i')
-        self.s32(i)
+        forms = [long_form(i)]
+        if -0x80000000 <= i < 0x80000000:
+            forms.append(b'i' + S32.pack(i))
+        self.buf += pick(forms)
+
+    def dump_float(self, f):
+        self.buf += pick([b'g' + F64.pack(f), float_form(b'f', f)])
+
+    def dump_complex(self, c):
+        self.buf += pick([b'y' + F64.pack(c.real) + F64.pack(c.imag),
+                          float_form(b'x', c.real) + float_form(b'', c.imag)])
 
     def dump_str(self, s):
-        if len(s) < 0x80:
-            self.fp.write(b'z')
-            self.u8(len(s))
+        if self.can_ref(s):
+            return self.dump_ref(s)
+        if s.isascii():
+            data = s.encode()
+            forms = [b'a' + U32.pack(len(data))]
+            if len(data) < 0x100:
+                forms.append(b'z' + bytes((len(data),)))
         else:
-            self.fp.write(b'a')
-            self.u32(len(s))
-        self.fp.write(s.encode())
+            data = s.encode('utf-8', 'surrogatepass')
+            forms = [b'u' + U32.pack(len(data))]
+        self.buf += pick(forms)
+        self.buf += data
 
     def dump_bytes(self, b):
-        self.fp.write(b's')
+        self.buf += b's'
         self.u32(len(b))
-        self.write(b)
+        self.buf += b
 
     def dump_tuple(self, t):
-        self.fp.write(b')')
-        self.u8(len(t))
+        forms = [b'(' + U32.pack(len(t))]
+        if len(t) < 0x100:
+            forms.append(b')' + bytes((len(t),)))
+        self.buf += pick(forms)
         for x in t:
-            self.dump(x)
+            self.put(x)
+
+    def dump_frozenset(self, s):
+        self.buf += b'>'
+        self.u32(len(s))
+        for x in set_order(s):
+            self.put(x)
+
+    def dump_set(self, s):
+        self.buf += b'<'
+        self.u32(len(s))
+        for x in set_order(s):
+            self.put(x)
 
     def dump_code(self, co):
-        self.fp.write(b'c')
-        co = Transcoder(co, self.force, self.verbose).transcode(4)
-        self.u32(co.co_argcount)
-        self.u32(co.co_posonlyargcount)
-        self.u32(co.co_kwonlyargcount)
-        self.u32(co.co_nlocals)
-        self.u32(co.co_stacksize)
-        self.u32(co.co_flags)
-        self.dump(co.co_code)
-        self.dump(co.co_consts)
-        self.dump(co.co_names)
-        self.dump(co.co_varnames)
-        self.dump(co.co_freevars)
-        self.dump(co.co_cellvars)
-        self.dump(co.co_filename)
-        self.dump(co.co_name)
-        self.u32(co.co_firstlineno)
-        self.dump(self.write_lnotab and co.co_lnotab or b'')
-
-
-def main():
+        co = self.transcode(co)
+        name = co.co_name
+        outer = self.fields[-1] if self.fields else None
+        self.mark(f'header of {name}')
+        self.write(BACKEND.code_header(co))
+        lines = getattr(co, BACKEND.line_field) if self.write_lnotab else b''
+        if not self.force and invalid(lines):
+            # no line numbers are better than an invalid pyc; only 3.11
+            # line tables ever are
+            lines = b''
+            if self.warnings is not None:
+                self.warnings.append(f'dropped the line numbers of {name}')
+        for field, value in BACKEND.code_fields(co, lines):
+            self.mark(f'{field} of {name}')
+            if field == 'co_firstlineno':
+                self.u32(value)
+            else:
+                self.put(value)
+        if outer is not None:
+            # whatever follows belongs to the enclosing object again
+            self.mark(outer)
+
+
+class Transcoded:
+    # a code object as transcoding would leave it, as far as can be told
+    # without doing it: new code and line table, stack size and table
+    # lengths fixed, and everything else the same
+    co_code = _co_code_adaptive = b''
+
+    def __init__(self, co):
+        self.co = co
+        self.co_stacksize = maybe_bigger(co.co_stacksize)
+        setattr(self, BACKEND.line_field, b'')
+        for field in BACKEND.tables:
+            table = getattr(co, field)
+            if len(table) <= 0x80:
+                continue
+            while invalidu32(len(table)):
+                table += (filler(field, len(table)),)
+            setattr(self, field, table)
+        self.co_nlocals = len(self.co_varnames)
+
+    def __getattr__(self, name):
+        return getattr(self.co, name)
+
+
+class ScanDumper(NorefMarshalDumper):
+    # dumps stand-ins for transcoded code objects, and collects whatever
+    # is still invalid, which transcoding cannot help
+    def transcode(self, co):
+        return Transcoded(co)
+
+    def validate(self):
+        self.problems = self.invalid_fields()
+
+
+def scan(codeobj):
+    # why codeobj cannot be written as valid UTF-8 however its code is
+    # transcoded, if it cannot; much cheaper than transcoding
+    dumper = ScanDumper(io.BytesIO())
+    dumper.dump(codeobj)
+    return dumper.problems
+
+
+# flags of PEP 552 headers
+PYC_TIMESTAMP = 0
+PYC_UNCHECKED_HASH = 1
+PYC_CHECKED_HASH = 3
+INVALIDATION_MODES = ('none', 'timestamp', 'checked-hash', 'unchecked-hash')
+
+
+def source_digest(source):
+    # stands in for the source hash of unchecked pycs, which CPython never
+    # looks at; the real one is hardly ever valid UTF-8
+    return importlib.util.source_hash(source).hex()[:8].encode()
+
+
+def pyc_header(path, source, mode='timestamp', max_shift=3600,
+               warnings=None):
+    # the 16 bytes before the code, as valid UTF-8; the source mtime may
+    # be moved up to max_shift seconds ahead to get there, and failing
+    # that, timestamps fall back to hashes and checked hashes to unchecked,
+    # and each fallback goes to warnings
+    if mode == 'none':
+        return MAGIC_NUMBER + bytes(12)
+
+    asked = mode
+    if mode == 'timestamp':
+        st = os.stat(path)
+        mtime = int(st.st_mtime)
+        size = st.st_size & 0xffffffff
+        for shift in range(max_shift + 1):
+            if not invalidu32((mtime + shift) & 0xffffffff):
+                break
+        else:
+            shift = None
+        if shift is not None and not invalidu32(size):
+            if shift:
+                os.utime(path, (st.st_atime, mtime + shift))
+            return (MAGIC_NUMBER + U32.pack(PYC_TIMESTAMP)
+                    + U32.pack((mtime + shift) & 0xffffffff) + U32.pack(size))
+        mode = 'checked-hash'
+
+    if mode == 'checked-hash':
+        source_hash = importlib.util.source_hash(source)
+        if not invalid(source_hash):
+            if warnings is not None and mode != asked:
+                warnings.append(downgraded(asked, mode))
+            return MAGIC_NUMBER + U32.pack(PYC_CHECKED_HASH) + source_hash
+
+    if warnings is not None and asked != 'unchecked-hash':
+        warnings.append(downgraded(asked, 'unchecked-hash'))
+    return MAGIC_NUMBER + U32.pack(PYC_UNCHECKED_HASH) + source_digest(source)
+
+
+def downgraded(asked, mode):
+    return (f'no {asked} header is valid UTF-8, so it is {mode}'
+            + ', which CPython never checks' * (mode == 'unchecked-hash'))
+
+
+def reused_header(data, mode='none', warnings=None):
+    # pyc_header() for a pyc or marshalled code as input, which have no
+    # source to go by; the old header stays if it is of the kind asked
+    # for and valid UTF-8, and unchecked hashes take over otherwise
+    if mode == 'none':
+        return MAGIC_NUMBER + bytes(12)
+    flags = {'timestamp': PYC_TIMESTAMP, 'checked-hash': PYC_CHECKED_HASH,
+             'unchecked-hash': PYC_UNCHECKED_HASH}[mode]
+    if (data[:4] == MAGIC_NUMBER and not invalid(data[4:16])
+            and data[4:8] == U32.pack(flags)):
+        return data[:16]
+    if warnings is not None and mode != 'unchecked-hash':
+        warnings.append(downgraded(mode, 'unchecked-hash'))
+    return MAGIC_NUMBER + U32.pack(PYC_UNCHECKED_HASH) + source_digest(data)
+
+
+# the payload is zlib data as ASCII: the low 7 bits of every byte, then
+# the high bits of every 7 bytes in one more character; translate() and
+# big ints put the bytes back together without a Python-level loop
+STAGER = """\
+import marshal
+import zlib
+payload = {payload!r}
+size = int({size!r})
+bits = {bits!r}
+table = {{i: bits[7 * i:7 * i + 7] for i in range(len(bits) // 7)}}
+low = int.from_bytes(payload[:size].encode('latin-1'), 'big')
+high = payload[size:].translate(table).encode('latin-1')[:size]
+data = (low | int.from_bytes(high, 'big')).to_bytes(size, 'big')
+exec(marshal.loads(zlib.decompress(data)))
+"""
+# for each 7 bit character, its bits as 0x00 or 0x80 characters
+STAGER_BITS = ''.join(chr(i >> k & 1) for i in range(0x80)
+                      for k in range(6, -1, -1)).replace('\1', '\x80')
+
+
+def pack7(data):
+    highs = []
+    for i in range(0, len(data), 7):
+        chunk = data[i:i + 7]
+        high = 0
+        for k, b in enumerate(chunk):
+            high |= (b >> 7) << 6 - k
+        highs.append(high)
+    text = (bytes(b & 0x7f for b in data) + bytes(highs)).decode()
+    # the length of the string has to be encodable as well
+    while invalidu32(len(text)):
+        text += '\0'
+    return text
+
+
+def make_stager(codeobj):
+    # source of a module that unpacks and runs codeobj, with nothing
+    # in it that transcodes badly, whatever is in codeobj
+    data = zlib.compress(marshal.dumps(codeobj), 9)
+    return STAGER.format(payload=pack7(data), size=str(len(data)),
+                         bits=STAGER_BITS)
+
+
+# a bundle is this, as a pyc, followed by the marshalled modules, a line
+# of name, kind, offset and size for each of them, and the offset of
+# those lines in 10 digits on a line of its own; running the bundle runs
+# its __main__ module, importing it makes its modules importable.
+# No try or with, which 3.11 cannot encode
+BUNDLE_LOADER = """\
+import marshal
+import sys
+from importlib.machinery import ModuleSpec
+
+
+class BundleFinder:
+    # unmarshals each module when it is first imported
+    def __init__(self, path):
+        fp = open(path, 'rb')
+        self.data = fp.read()
+        fp.close()
+        self.path = path
+        self.modules = {}
+        end = len(self.data) - 1
+        start = int(self.data[end - 10:end])
+        for line in self.data[start:end - 11].decode().splitlines():
+            name, kind, offset, size = line.split('\\t')
+            self.modules[name] = kind == 'package', int(offset), int(size)
+
+    def find_spec(self, name, path=None, target=None):
+        if name in self.modules:
+            return ModuleSpec(name, self, origin=self.path,
+                              is_package=self.modules[name][0])
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__spec__.name), module.__dict__)
+
+    def get_code(self, name):
+        package, offset, size = self.modules[name]
+        return marshal.loads(memoryview(self.data)[offset:offset + size])
+
+    def get_source(self, name):
+        return None
+
+    def is_package(self, name):
+        return self.modules[name][0]
+
+
+finder = BundleFinder(__file__)
+sys.meta_path.insert(0, finder)
+if __name__ == '__main__' and '__main__' in finder.modules:
+    exec(finder.get_code('__main__'))
+"""
+
+
+def bundle_loader(verbose=0, force=False, warnings=None):
+    # the pyc that write_bundle() puts the modules after
+    buf = io.BytesIO()
+    write_pyc(buf, compile(BUNDLE_LOADER, '<bundle>', 'exec'), force,
+              verbose=verbose, warnings=warnings)
+    return buf.getvalue()
+
+
+def write_bundle(fp, modules, loader=None):
+    # modules are (name, is_package, marshalled code) each
+    data = bytearray(loader or bundle_loader())
+    index = []
+    for name, package, code in modules:
+        kind = 'package' if package else 'module'
+        index.append(f'{name}\t{kind}\t{len(data)}\t{len(code)}\n')
+        data += code
+    start = len(data)
+    data += ''.join(index).encode()
+    data += b'\n%010d\n' % start
+    fp.write(data)
+
+
+def write_pyc(fp, codeobj, force=False, write_lnotab=True, verbose=0,
+              cache=None, refs=False, stats=None, header=None, workers=1,
+              verify=False, profile=None, warnings=None):
+    # like marshal.dump(codeobj, fp), but (almost) no remembering and
+    # references; it also fixes up code whenever it can be made more
+    # UTF-8 valid, and checks the header along with it
+    NorefMarshalDumper(fp, force, write_lnotab, verbose, cache, refs, stats,
+                       workers, verify, profile, warnings).dump(
+                           codeobj, header or MAGIC_NUMBER + bytes(12))
+
+
+def use_stager(codeobj, reason, verbose=0, warnings=None):
+    # a warning, or with none to go to, a message for -v
+    if warnings is not None:
+        warnings.append(f'using a stager, {reason}')
+    elif verbose:
+        print(f'{codeobj.co_filename}: using a stager, {reason}',
+              file=sys.stderr)
+
+
+def staged(codeobj, stager=False, force=False, verbose=0, warnings=None):
+    # codeobj, or a stager for it; 'auto' picks the stager when scan()
+    # finds codeobj hopeless, unless forced to write it anyway
+    if stager == 'auto':
+        problems = [] if force else scan(codeobj)
+        if problems:
+            use_stager(codeobj, problems[0], verbose, warnings)
+        stager = bool(problems)
+    if stager:
+        return compile(make_stager(codeobj), codeobj.co_filename, 'exec')
+    return codeobj
+
+
+def dump_staged(write, codeobj, stager=False, force=False, verbose=0,
+                warnings=None, stats=None):
+    # what write(fp, code) puts in fp for staged(codeobj), and nothing
+    # if it fails; with 'auto', transcoding can still fail where scan()
+    # saw no problem, with invalid UTF-8, jumps that do not settle or
+    # code that does not verify, and then a stager stands in after all;
+    # warnings and stats, which write() shares, forget the failed try
+    code = staged(codeobj, stager, force, verbose, warnings)
+    mark = len(warnings) if warnings is not None else 0
+    stats_mark = len(stats) if stats is not None else 0
+    buf = io.BytesIO()
+    try:
+        write(buf, code)
+    except (ValueError, AssertionError) as e:
+        # a stager cannot help where the magic number is invalid
+        if (stager != 'auto' or code is not codeobj or force
+                or invalid(MAGIC_NUMBER)):
+            raise
+        if warnings is not None:
+            del warnings[mark:]
+        if stats is not None:
+            del stats[stats_mark:]
+        reason = e.reason if isinstance(e, UnicodeDecodeError) else str(e)
+        use_stager(codeobj, reason or type(e).__name__, verbose, warnings)
+        buf = io.BytesIO()
+        write(buf, staged(codeobj, True))
+    return buf.getvalue()
+
+
+# what input is, unless told: pycs by their name, and source otherwise,
+# as raw marshal data looks like nothing in particular
+INPUT_FORMATS = ('source', 'pyc', 'marshal')
+
+
+def format_of(path):
+    return 'pyc' if path is not None and path.endswith('.pyc') else 'source'
+
+
+def loads_code(data, fmt='pyc', path=None):
+    # the code in a pyc of this Python or in marshalled code
+    where = path or 'input'
+    if fmt == 'pyc':
+        if data[:4] != MAGIC_NUMBER:
+            raise ValueError(f'{where} is not a pyc of this Python')
+        data = memoryview(data)[16:]
+    try:
+        codeobj = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        codeobj = None
+    if not isinstance(codeobj, CodeType):
+        raise ValueError(f'{where} holds no marshalled code')
+    return codeobj
+
+
+def renamed(co, filename):
+    # co as if compiled from filename, nested code objects included
+    return co.replace(co_filename=filename, co_consts=tuple(
+        renamed(const, filename) if isinstance(const, CodeType) else const
+        for const in co.co_consts))
+
+
+def input_code(data, path=None, filename=None, mode='exec',
+               invalidation_mode='none', warnings=None, input_format=None):
+    # the code in data, read from path, and the pyc header to go with it;
+    # data is source, which is compiled as filename, or else path, or with
+    # input_format or a name that says so, a pyc of this Python or
+    # marshalled code, which are loaded as they are unless filename
+    # renames them
+    input_format = input_format or format_of(path)
+    if input_format != 'source':
+        codeobj = loads_code(data, input_format, path)
+        if filename is not None:
+            codeobj = renamed(codeobj, filename)
+        return codeobj, reused_header(data, invalidation_mode, warnings)
+
+    if filename is None:
+        filename = '<string>' if path is None else os.path.abspath(path)
+    return (compile(data, filename, mode),
+            pyc_header(path, data, invalidation_mode, warnings=warnings))
+
+
+def load_code(infile, filename=None, mode='exec', invalidation_mode='none',
+              warnings=None, input_format=None):
+    # input_code() of infile
+    with open(infile, 'rb') as fp:
+        data = fp.read()
+    return input_code(data, infile, filename, mode, invalidation_mode,
+                      warnings, input_format)
+
+
+def print_warnings(infile, warnings):
+    for warning in warnings:
+        print(f'{infile}: warning: {warning}', file=sys.stderr)
+
+
+def compile_file(infile, outfile, filename=None, mode='exec', force=False,
+                 write_lnotab=True, verbose=0, cache=None, refs=False,
+                 stats=None, invalidation_mode='none', stager=False,
+                 workers=1, verify=False, profile=None, warnings=None,
+                 input_format=None):
+    codeobj, header = load_code(infile, filename, mode, invalidation_mode,
+                                warnings, input_format)
+    write = functools.partial(
+        write_pyc, force=force, write_lnotab=write_lnotab, verbose=verbose,
+        cache=cache, refs=refs, stats=stats, header=header, workers=workers,
+        verify=verify, profile=profile, warnings=warnings)
+    data = dump_staged(write, codeobj, stager, force, verbose, warnings,
+                       stats)
+
+    dirname = os.path.dirname(outfile)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(outfile, 'wb') as fp:
+        fp.write(data)
+
+
+# The library API.  All of it is safe to call from several threads at
+# once, and shares nothing between calls unless given the same cache,
+# stats or warnings.  Warnings are what -f lets through, header included,
+# stagers, dropped line numbers and header fallbacks; stats are as --stats
+# writes them.
+
+def transcode_code(codeobj, force=False, *, cache=None, verify=False,
+                   profile=None, stats=None, warnings=None):
+    # codeobj with the code in it and in all of its nested code objects
+    # transcoded; write_pyc() and NorefMarshalDumper then write it as it
+    # is, rather than marshal, which would not keep it valid UTF-8
+    dumper = NorefMarshalDumper(None, force, cache=cache, stats=stats,
+                                verify=verify, profile=profile,
+                                warnings=warnings)
+
+    def walk(co):
+        co = co.replace(co_consts=tuple(
+            walk(const) if isinstance(const, CodeType) else const
+            for const in co.co_consts))
+        return dumper.transcode(co)
+
+    return walk(codeobj)
+
+
+def compile_source(source, filename='<string>', mode='exec', **options):
+    # the bytes of a UTF-8 pyc of source, a str or bytes, as the command
+    # line would write them, but without any files; timestamps need one.
+    # With input_format, bytes may be a pyc or marshalled code as well
+    buf = io.BytesIO()
+    write_source(buf, source, filename, mode, **options)
+    return buf.getvalue()
+
+
+def write_source(fp, source, filename='<string>', mode='exec', *,
+                 force=False, lnotab=True, refs=False, stager=False,
+                 invalidation_mode='none', verify=False, cache=None,
+                 profile=None, stats=None, warnings=None, workers=1,
+                 input_format=None):
+    # compile_source() into fp, anything with a write() method, such as
+    # a pipe or a socket file. The dumper writes to fp itself, in one go
+    # once the whole pyc is known to be valid, so nothing gets written
+    # unless all goes well; it is not streamed, as it cannot be checked
+    # before it is complete. Only automatic stagers take another copy,
+    # for another try with a stager
+    if invalidation_mode == 'timestamp':
+        raise ValueError('timestamps need a source file')
+    if isinstance(source, str):
+        source = source.encode()
+    codeobj, header = input_code(source, None, filename, mode,
+                                 invalidation_mode, warnings, input_format)
+    write = functools.partial(
+        write_pyc, force=force, write_lnotab=lnotab, cache=cache, refs=refs,
+        stats=stats, header=header, workers=workers, verify=verify,
+        profile=profile, warnings=warnings)
+    if stager == 'auto':
+        fp.write(dump_staged(write, codeobj, stager, force,
+                             warnings=warnings, stats=stats))
+    else:
+        write(fp, staged(codeobj, stager))
+
+
+def _compile_job(job):
+    # stats cannot be shared with worker processes, so they come back
+    # with the result
+    infile, outfile, kwargs, want_stats = job
+    stats = [] if want_stats else None
+    warnings = []
+    try:
+        compile_file(infile, outfile, stats=stats, warnings=warnings,
+                     **kwargs)
+    except Exception as e:
+        return infile, f'{type(e).__name__}: {e}', stats
+    print_warnings(infile, warnings)
+    return infile, None, stats
+
+
+def _bundle_job(job):
+    # the marshalled module, for write_bundle()
+    infile, name, package, kwargs, want_stats = job
+    stats = [] if want_stats else None
+    warnings = []
+    kwargs = dict(kwargs)
+    stager = kwargs.pop('stager', False)
+
+    def write(fp, codeobj):
+        NorefMarshalDumper(fp, stats=stats, warnings=warnings,
+                           **kwargs).dump(codeobj)
+
+    mode = kwargs.pop('mode', 'exec')
+    input_format = kwargs.pop('input_format', None)
+    try:
+        codeobj, _ = load_code(infile, None, mode,
+                               input_format=input_format)
+        data = dump_staged(write, codeobj, stager,
+                           kwargs.get('force', False),
+                           kwargs.get('verbose', 0), warnings, stats)
+    except Exception as e:
+        return infile, f'{type(e).__name__}: {e}', stats, None
+    print_warnings(infile, warnings)
+    return infile, None, stats, (name, package, data)
+
+
+def _glob_base(pattern):
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+
+def source_path(path):
+    # where the source of path is, if path is a pyc, which may as well
+    # be of another Python, or not exist at all
+    if not path.endswith('.pyc'):
+        return path
+    if os.path.basename(os.path.dirname(path)) == '__pycache__':
+        try:
+            return importlib.util.source_from_cache(path)
+        except ValueError:
+            return None
+    return path[:-1]
+
+
+def _is_pyc(path):
+    with open(path, 'rb') as fp:
+        return fp.read(4) == MAGIC_NUMBER
+
+
+def iter_sources(paths, sourceless=False):
+    # directories give their sources, and if asked to, pycs of this
+    # Python where the source is gone
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    name = os.path.join(root, name)
+                    if name.endswith('.py'):
+                        yield name, path
+                    elif sourceless and name.endswith('.pyc'):
+                        src = source_path(name)
+                        if (src is not None and not os.path.exists(src)
+                                and _is_pyc(name)):
+                            yield name, path
+        elif glob.has_magic(path):
+            base = _glob_base(path)
+            for name in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(name):
+                    yield name, base
+        else:
+            yield path, os.path.dirname(path)
+
+
+def batch_jobs(paths, output_dir=None, want_stats=False, sourceless=False,
+               **kwargs):
+    # pycs are transcoded in place, or into the same place in output_dir,
+    # so that those in __pycache__ stay where nothing imports them
+    for src, base in iter_sources(paths, sourceless):
+        pyc = src.endswith('.pyc')
+        if output_dir is None:
+            dst = src if pyc else importlib.util.cache_from_source(src)
+        else:
+            rel = os.path.relpath(src, base or os.curdir)
+            if not pyc:
+                rel = os.path.splitext(rel)[0] + '.pyc'
+            dst = os.path.join(output_dir, rel)
+        yield src, dst, kwargs, want_stats
+
+
+def module_name(src, base):
+    # the name that src is imported by from base, and if it is a package
+    parts = os.path.relpath(os.path.splitext(source_path(src) or src)[0],
+                            base or os.curdir).split(os.sep)
+    package = parts[-1] == '__init__'
+    if package:
+        parts.pop()
+    return '.'.join(parts), package
+
+
+def bundle_jobs(paths, want_stats=False, **kwargs):
+    for src, base in iter_sources(paths):
+        name, package = module_name(src, base)
+        yield src, name, package, kwargs, want_stats
+
+
+def _collect(results, stats):
+    failed = []
+    for src, err, job_stats in results:
+        if err is not None:
+            failed.append((src, err))
+        if stats is not None:
+            stats.extend(job_stats)
+    return failed
+
+
+def compile_batch(paths, output_dir=None, workers=1, stats=None, **kwargs):
+    jobs = batch_jobs(paths, output_dir, stats is not None, **kwargs)
+    if workers == 1:
+        return _collect(map(_compile_job, jobs), stats)
+
+    with ProcessPoolExecutor(workers or None) as pool:
+        return _collect(pool.map(_compile_job, jobs, chunksize=4), stats)
+
+
+def compile_bundle(paths, outfile, workers=1, stats=None, **kwargs):
+    # like compile_batch(), but into one bundle, which leaves out the
+    # modules that fail
+    # the loader first, as no module is any use where it fails
+    warnings = []
+    loader = bundle_loader(kwargs.get('verbose', 0),
+                           kwargs.get('force', False), warnings)
+    jobs = bundle_jobs(paths, stats is not None, **kwargs)
+    if workers == 1:
+        results = list(map(_bundle_job, jobs))
+    else:
+        with ProcessPoolExecutor(workers or None) as pool:
+            results = list(pool.map(_bundle_job, jobs, chunksize=4))
+
+    buf = io.BytesIO()
+    write_bundle(buf, [module for *_, module in results
+                       if module is not None], loader)
+    with open(outfile, 'wb') as fp:
+        fp.write(buf.getvalue())
+    print_warnings(outfile, warnings)
+    return _collect([result[:3] for result in results], stats)
+
+
+def write_stats(stats, path):
+    # CSV if the name says so, JSON otherwise
+    with open(path, 'w', newline='') as fp:
+        if not path.endswith('.csv'):
+            json.dump(stats, fp, indent=2)
+            return
+
+        fields = ['filename', 'firstlineno', 'name', 'size', 'new_size',
+                  'nops', 'extended_args', 'rounds', 'repairs', 'widened',
+                  'stacksize', 'new_stacksize', 'valid', 'cached',
+                  'skipped', 'time_split', 'time_relax', 'time_assemble',
+                  'lines']
+        writer = csv.DictWriter(fp, fields)
+        writer.writeheader()
+        for entry in stats:
+            row = dict(entry)
+            for phase, seconds in row.pop('time', {}).items():
+                row[f'time_{phase}'] = seconds
+            row['lines'] = ' '.join(f'{line}:{count}' for line, count
+                                    in row.get('lines', {}).items())
+            writer.writerow(row)
+
+
+def profile_key(co):
+    # what tells code objects apart from one process to the next
+    return co.co_filename, co.co_firstlineno, co.co_name
+
+
+def run_profile(path, args=()):
+    # how many times each instruction of each code object ran while path
+    # ran as __main__, by the offset that opcode tracing sees, which is
+    # that of the first EXTENDED_ARG in front of it if any
+    counts = {}
+
+    def trace(frame, event, arg):
+        frame.f_trace_opcodes = True
+        table = counts.setdefault(profile_key(frame.f_code), Counter())
+
+        def trace_opcode(frame, event, arg):
+            if event == 'opcode':
+                table[frame.f_lasti] += 1
+            return trace_opcode
+        return trace_opcode
+
+    # the same file names as compile_file() gives the code
+    path = os.path.abspath(path)
+    saved = sys.argv
+    sys.argv = [path, *args]
+    sys.settrace(trace)
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        sys.settrace(None)
+        sys.argv = saved
+    return counts
+
+
+def write_profile(counts, path):
+    with open(path, 'w') as fp:
+        json.dump([{'filename': filename, 'firstlineno': firstlineno,
+                    'name': name, 'counts': dict(sorted(table.items()))}
+                   for (filename, firstlineno, name), table
+                   in sorted(counts.items())], fp, indent=2)
+
+
+def load_profile(path):
+    # for Transcoder, by profile_key()
+    with open(path) as fp:
+        return {(entry['filename'], entry['firstlineno'], entry['name']):
+                {int(offset): count
+                 for offset, count in entry['counts'].items()}
+                for entry in json.load(fp)}
+
+
+def profile_main(argv):
+    import argparse
+
+    par = argparse.ArgumentParser(
+        prog='utfpyc.py profile',
+        description='run a script and count how often each instruction '
+                    'runs, so that --profile keeps padding out of the '
+                    'hot paths')
+    par.add_argument('-o', '--output', required=True, metavar='FILE',
+                     help='write the counts to FILE, as JSON')
+    par.add_argument('script')
+    par.add_argument('args', nargs=argparse.REMAINDER)
+    args = par.parse_args(argv)
+    write_profile(run_profile(args.script, args.args), args.output)
+
+
+class UTF8SourceLoader(importlib.machinery.SourceFileLoader):
+    # serves and refreshes UTF-8 pycs in __pycache__ instead of the
+    # usual ones, which it would otherwise overwrite them with
+    def is_fresh(self, path, data):
+        if len(data) < 16 or data[:4] != MAGIC_NUMBER:
+            return False
+        flags, = U32.unpack_from(data, 4)
+        if flags == PYC_TIMESTAMP:
+            st = self.path_stats(path)
+            return data[8:16] == (U32.pack(int(st['mtime']) & 0xffffffff)
+                                  + U32.pack(st['size'] & 0xffffffff))
+        if flags == PYC_CHECKED_HASH:
+            return data[8:16] == importlib.util.source_hash(
+                self.get_data(path))
+        if flags == PYC_UNCHECKED_HASH:
+            return data[8:16] == source_digest(self.get_data(path))
+        return False
+
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        cached = importlib.util.cache_from_source(path)
+        try:
+            data = self.get_data(cached)
+        except OSError:
+            data = b''
+        if self.is_fresh(path, data):
+            try:
+                return marshal.loads(memoryview(data)[16:])
+            except (EOFError, ValueError, TypeError):
+                pass
+
+        source = self.get_data(path)
+        if sys.dont_write_bytecode:
+            return self.source_to_code(source, path)
+        # never touch the source mtime on import
+        header = pyc_header(path, source, max_shift=0)
+        if header[4:8] == U32.pack(PYC_UNCHECKED_HASH):
+            # CPython without the hook would run it after edits
+            return super().get_code(fullname)
+        buf = io.BytesIO()
+        try:
+            write_pyc(buf, self.source_to_code(source, path), header=header)
+        except (ValueError, AssertionError):
+            # cannot be made valid UTF-8, so a stock pyc it is
+            return super().get_code(fullname)
+        self.set_data(cached, buf.getvalue())
+        return marshal.loads(buf.getvalue()[16:])
+
+
+class UTF8PathFinder:
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path,
+                                                        target)
+        if (spec is not None and type(spec.loader)
+                is importlib.machinery.SourceFileLoader):
+            spec.loader = UTF8SourceLoader(spec.loader.name,
+                                           spec.loader.path)
+        return spec
+
+    @classmethod
+    def invalidate_caches(cls):
+        importlib.machinery.PathFinder.invalidate_caches()
+
+
+def install_hook():
+    # import source modules through UTF-8 pycs from now on
+    if UTF8PathFinder in sys.meta_path:
+        return
+    try:
+        index = sys.meta_path.index(importlib.machinery.PathFinder)
+    except ValueError:
+        index = len(sys.meta_path)
+    sys.meta_path.insert(index, UTF8PathFinder)
+
+
+def uninstall_hook():
+    if UTF8PathFinder in sys.meta_path:
+        sys.meta_path.remove(UTF8PathFinder)
+
+
+# utfpyc serve answers one JSON line with another, with bytes in base64:
+# {"argv": [...], "cwd": ...} runs a command line like utfpyc.py there,
+# asking for {"stdin": ...} first when the input is "-", and answers
+# {"status": ..., "stdout": ..., "stderr": ...}; {"source": ...} or
+# {"path": ...} with "filename", "mode" and the flags of compile_file()
+# gets {"pyc": ..., "warnings": [...]} or {"error": ...} back
+SERVE_LIMIT = 1 << 30
+SERVE_CACHE = None
+
+
+class _Capture(io.BytesIO):
+    # stdin.buffer or stdout.buffer of a request, which main() closes
+    # when done with it
+    def __init__(self, name, data=b''):
+        super().__init__(data)
+        self.name = name
+
+    def close(self):
+        pass
+
+
+def _serve_init(cache_size):
+    global SERVE_CACHE
+    SERVE_CACHE = MemoryCache(cache_size)
+    # ^C goes to the server, which shuts the workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _serve_compile(request):
+    path = request.get('path')
+    if 'source' in request:
+        source = base64.b64decode(request['source'])
+    else:
+        with open(path, 'rb') as fp:
+            source = fp.read()
+    warnings = []
+    codeobj, header = input_code(source, path, request.get('filename'),
+                                 request.get('mode', 'exec'),
+                                 request.get('invalidation_mode', 'none'),
+                                 warnings, request.get('input_format'))
+    force = request.get('force', False)
+    write = functools.partial(
+        write_pyc, force=force, write_lnotab=request.get('lnotab', True),
+        cache=SERVE_CACHE, refs=request.get('refs', False), header=header,
+        verify=request.get('verify', False), warnings=warnings)
+    data = dump_staged(write, codeobj, request.get('stager', False), force,
+                       warnings=warnings)
+    return {'pyc': base64.b64encode(data).decode(), 'warnings': warnings}
+
+
+def _serve_main(request):
+    stdin = _Capture('<stdin>', base64.b64decode(request.get('stdin', '')))
+    stdout = io.TextIOWrapper(_Capture('<stdout>'), write_through=True)
+    stderr = io.StringIO()
+    saved = sys.stdin, sys.stdout, sys.stderr
+    cwd = os.getcwd()
+    status = 0
+    try:
+        os.chdir(request['cwd'])
+        sys.stdin = io.TextIOWrapper(stdin)
+        sys.stdout, sys.stderr = stdout, stderr
+        main(request['argv'], SERVE_CACHE)
+    except SystemExit as e:
+        status = e.code
+        if isinstance(status, str):
+            print(status, file=stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = saved
+        # for the relative paths of later requests to this worker
+        os.chdir(cwd)
+    return {'status': status or 0,
+            'stdout': base64.b64encode(stdout.buffer.getvalue()).decode(),
+            'stderr': stderr.getvalue()}
+
+
+def _serve_job(request):
+    # runs in a worker, which stays warm between requests, and which is
+    # no place for another server or for running scripts
+    if 'argv' in request:
+        if request['argv'][:1] in (['serve'], ['profile']):
+            return {'error': f'{request["argv"][0]} cannot run in a server'}
+        return _serve_main(request)
+    try:
+        return _serve_compile(request)
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+
+
+def reads_stdin(argv):
+    # whether the command line compiles its standard input; --help and
+    # the like are left for a worker to print to the client
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            args = make_parser().parse_args(argv)
+    except SystemExit:
+        return False
+    return (args.infile == '-' and args.output_dir is None
+            and not args.pycache)
+
+
+def serve(path, workers=0, cache_size=64 << 20):
+    import asyncio
+
+    # a server that is still there keeps its socket
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            if os.path.exists(path):
+                os.unlink(path)
+        else:
+            raise OSError(f'{path} is already being served')
+
+    pool = ProcessPoolExecutor(workers or None, initializer=_serve_init,
+                               initargs=(cache_size,))
+
+    async def handle(reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if 'argv' in request and reads_stdin(request['argv']):
+                        writer.write(b'{"stdin": true}\n')
+                        line = await reader.readline()
+                        request['stdin'] = json.loads(line)['stdin']
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {'error': f'bad request: {e}'}
+                else:
+                    response = await loop.run_in_executor(
+                        pool, _serve_job, request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        server = await asyncio.start_unix_server(handle, path,
+                                                 limit=SERVE_LIMIT)
+        async with server:
+            await stop.wait()
+
+    try:
+        asyncio.run(run())
+    finally:
+        pool.shutdown()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def serve_main(argv):
+    import argparse
+
+    par = argparse.ArgumentParser(
+        prog='utfpyc.py serve',
+        description='compile for utfpyc_client.py and build tools '
+                    'on a Unix socket, with warm workers and caches')
+    par.add_argument('socket')
+    par.add_argument('-j', '--workers', type=int, default=0,
+                     help='number of worker processes '
+                          '(default: one per CPU)')
+    par.add_argument('--cache-size', type=int, default=64,
+                     help='MiB of transcoded code objects each worker '
+                          'keeps in memory (default: %(default)s)')
+    args = par.parse_args(argv)
+    try:
+        serve(args.socket, args.workers, args.cache_size << 20)
+    except OSError as e:
+        par.error(str(e))
+
+
+def make_parser():
     import argparse
 
     par = argparse.ArgumentParser()
@@ -377,27 +2504,155 @@ def main():
     par.add_argument('-v', '--verbose', default=0, action='count')
     par.add_argument('-f', '--force', action='store_true',
                      help='force write even if UTF-8 cannot be fully acheived')
+    par.add_argument('--refs', action='store_true',
+                     help='reduce the output size by writing repeated '
+                          'strings only once, where UTF-8 allows')
     par.add_argument('--version', action='version',
                      version='%(prog)s {}'.format(__version__))
-    par.add_argument('infile', type=argparse.FileType('rb'))
-    par.add_argument('outfile', type=argparse.FileType('wb'))
-
-    args = par.parse_args()
-
-    if args.filename is None:
-        args.filename = os.path.abspath(args.infile.name)
-
-    with args.infile as fp:
-        codeobj = compile(fp.read(), args.filename, args.mode)
+    batch = par.add_mutually_exclusive_group()
+    batch.add_argument('-o', '--output-dir', default=None,
+                       help='batch mode: compile all given files, '
+                            'directories and globs into a mirrored tree')
+    batch.add_argument('--pycache', action='store_true',
+                       help='batch mode: compile all given files, '
+                            'directories and globs into __pycache__')
+    batch.add_argument('--bundle', default=None, metavar='FILE',
+                       help='batch mode: compile all given files, '
+                            'directories and globs into one pyc, which '
+                            'imports them lazily once imported or run')
+    par.add_argument('-j', '--workers', type=int, default=1,
+                     help='number of worker processes, for files in batch '
+                          'mode and for code objects of the one file '
+                          'otherwise (0 means one per CPU)')
+    par.add_argument('--cache-dir', default=None,
+                     help='reuse transcoded code objects stored in this '
+                          'directory across runs')
+    par.add_argument('--cache-size', type=int, default=64,
+                     help='evict least recently used cache entries above '
+                          'this many MiB (default: %(default)s)')
+    stager = par.add_mutually_exclusive_group()
+    stager.add_argument('--stager', action='store_const', const=True,
+                        default='auto',
+                        help='write a stager that carries the compiled '
+                             'input compressed, for code that cannot be '
+                             'made valid UTF-8 itself; unless forced, this '
+                             'happens anyway to modules that a quick scan '
+                             'finds hopeless')
+    stager.add_argument('--no-stager', action='store_const', const=False,
+                        dest='stager',
+                        help='fail on modules that cannot be made valid '
+                             'UTF-8 rather than write stagers for them')
+    par.add_argument('--invalidation-mode', default='none',
+                     choices=INVALIDATION_MODES,
+                     help='write a PEP 552 header that lets CPython tell '
+                          'stale pycs; timestamps may move the source mtime '
+                          'ahead a little and fall back to hashes, which '
+                          'end up unchecked unless the hash is valid UTF-8 '
+                          '(default: %(default)s, an all-zero header)')
+    par.add_argument('--stats', default=None, metavar='FILE',
+                     help='write per-code-object transcoding statistics '
+                          'to FILE, as CSV if it ends in .csv, else JSON')
+    par.add_argument('--verify', action='store_true',
+                     help='check statically that every transcoded code '
+                          'object does the same as the original')
+    par.add_argument('--profile', default=None, metavar='FILE',
+                     help='keep padding out of the code that ran most '
+                          'often in FILE, as written by utfpyc.py profile')
+    par.add_argument('--input-format', default=None, choices=INPUT_FORMATS,
+                     help='read the input as source, as a pyc of this '
+                          'Python or as raw marshalled code (default: pyc '
+                          'for names ending in .pyc, source otherwise)')
+    par.add_argument('--sourceless', action='store_true',
+                     help='batch mode: also compile the pycs in directories '
+                          'whose source is gone, into the same layout; '
+                          'CPython never imports those in __pycache__')
+    par.add_argument('infile')
+    par.add_argument('outfile', nargs='*')
+    return par
+
+
+def main(argv=None, cache=None):
+    # cache is used unless --cache-dir gives another one
+    import argparse
 
-    with args.outfile as fp:
-        fp.write(MAGIC_NUMBER)
-        fp.truncate(16)
-        fp.seek(16)
-        # like marshal.dump(codeobj, fp), but no remembering and references;
-        # it also fixes up code whenever it can be made more UTF-8 valid
-        NorefMarshalDumper(fp, args.force, args.lnotab,
-                           args.verbose).dump(codeobj)
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['serve']:
+        return serve_main(argv[1:])
+    if argv[:1] == ['profile']:
+        return profile_main(argv[1:])
+
+    par = make_parser()
+    args = par.parse_args(argv)
+
+    if args.cache_dir is not None:
+        cache = TranscodeCache(args.cache_dir, args.cache_size << 20)
+    stats = None if args.stats is None else []
+    profile = None if args.profile is None else load_profile(args.profile)
+
+    if args.output_dir is not None or args.pycache or args.bundle:
+        if args.filename is not None:
+            par.error('--filename cannot be used in batch mode')
+        kwargs = dict(mode=args.mode, force=args.force,
+                      write_lnotab=args.lnotab, verbose=args.verbose,
+                      cache=cache, refs=args.refs, stats=stats,
+                      stager=args.stager, verify=args.verify,
+                      profile=profile, input_format=args.input_format)
+        if args.bundle is None:
+            failed = compile_batch([args.infile] + args.outfile,
+                                   args.output_dir, args.workers,
+                                   invalidation_mode=args.invalidation_mode,
+                                   sourceless=args.sourceless, **kwargs)
+        elif args.invalidation_mode != 'none':
+            par.error('bundles have no sources to check against')
+        elif args.sourceless:
+            par.error('bundles would import sourceless pycs in __pycache__')
+        else:
+            failed = compile_bundle([args.infile] + args.outfile,
+                                    args.bundle, args.workers, **kwargs)
+        if cache is not None:
+            cache.trim()
+        if stats is not None:
+            write_stats(stats, args.stats)
+        for src, err in failed:
+            print(f'{src}: {err}', file=sys.stderr)
+        sys.exit(bool(failed))
+
+    if len(args.outfile) != 1:
+        par.error('exactly one outfile expected outside of batch mode')
+    if args.sourceless:
+        par.error('--sourceless only works in batch mode')
+    if args.infile == '-' and args.invalidation_mode == 'timestamp':
+        par.error('timestamps need a source file, not stdin')
+
+    infile = argparse.FileType('rb')(args.infile)
+
+    with infile as fp:
+        data = fp.read()
+    warnings = []
+    try:
+        codeobj, header = input_code(data, infile.name, args.filename,
+                                     args.mode, args.invalidation_mode,
+                                     warnings, args.input_format)
+    except ValueError as e:
+        par.error(str(e))
+    write = functools.partial(
+        write_pyc, force=args.force, write_lnotab=args.lnotab,
+        verbose=args.verbose, cache=cache, refs=args.refs, stats=stats,
+        header=header, workers=args.workers, verify=args.verify,
+        profile=profile, warnings=warnings)
+    data = dump_staged(write, codeobj, args.stager, args.force, args.verbose,
+                       warnings, stats)
+
+    # the outfile is only opened once there is something to write to it
+    with argparse.FileType('wb')(args.outfile[0]) as fp:
+        fp.write(data)
+    print_warnings(infile.name, warnings)
+
+    if cache is not None:
+        cache.trim()
+    if stats is not None:
+        write_stats(stats, args.stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# utfpyc_client.py - run utfpyc.py command lines on a utfpyc serve
+# Copyright (C) 2021  Arusekk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# takes the same arguments as utfpyc.py, and imports next to nothing,
+# so that most of the time goes to the server doing the actual work
+
+import base64
+import json
+import os
+import socket
+import sys
+
+
+def run_locally(argv):
+    utfpyc = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'utfpyc.py')
+    os.execv(sys.executable, [sys.executable, utfpyc] + argv)
+
+
+def main():
+    argv = sys.argv[1:]
+    if argv[:1] in (['serve'], ['profile']):
+        # a server is no place for another server, or for running scripts
+        run_locally(argv)
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(os.environ['UTFPYC_SOCKET'])
+    except (KeyError, OSError):
+        # no server around, so do it the slow way
+        sock.close()
+        run_locally(argv)
+
+    with sock, sock.makefile('rb') as fp:
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        response = json.loads(fp.readline())
+        if response.get('stdin'):
+            data = base64.b64encode(sys.stdin.buffer.read()).decode()
+            sock.sendall(json.dumps({'stdin': data}).encode() + b'\n')
+            response = json.loads(fp.readline())
+
+    if 'error' in response:
+        sys.exit(f'utfpyc serve: {response["error"]}')
+    sys.stdout.buffer.write(base64.b64decode(response['stdout']))
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['status'])
+
+
+if __name__ == "__main__":
+    main()